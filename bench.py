@@ -0,0 +1,137 @@
+"""
+Offline benchmark of the environment provisioning flow.
+
+Runs the real provisioning steps of gcp.py against the fake clients of
+fake_gcp.py, for several VM counts and numbers of concurrent users, and
+reports the p50/p95 end-to-end time, the number of API calls per environment
+and the peak memory. No network access or Google Cloud account is needed.
+
+Usage:
+    python bench.py --vm-counts 1,5 --users 1,8 --time-scale 0.01
+"""
+import argparse
+import contextlib
+import io
+import json
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit.logger
+from streamlit import config
+
+import fake_gcp
+import gcp
+
+
+def percentile(values, fraction):
+    """Returns the value below which a fraction of the sorted values fall (nearest rank)."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def provision(user, vm_count):
+    """Provisions one environment and returns its end-to-end time and whether it succeeded."""
+    project_id = gcp.generate_unique_project_id(f"bench{user}")
+    start = time.monotonic()
+    run = gcp.run_provisioning_dag(gcp.environment_steps(project_id, f"bench{user}", vm_count, "100"))
+    instances = run.results.get("instances") or []
+    succeeded = not run.failed and all(result.status != "FAILED" for result in instances)
+    return time.monotonic() - start, succeeded
+
+
+def run_scenario(vm_count, users, repeat, cloud_options, time_scale):
+    """
+    Provisions users environments at the same time, repeat times, against a new FakeCloud.
+
+    Durations in the result are divided by time_scale, i.e. expressed in simulated seconds.
+    An untimed provisioning runs first, so that one-time setup (library imports, clients,
+    tracker threads) is neither counted as simulated time nor as peak memory. It runs
+    without exhausted zones, and the zone health and folder cache are reset after it
+    (install drops the folder cache), so that the timed rounds start from a cold state.
+    """
+    fake_gcp.install(fake_gcp.FakeCloud(time_scale=time_scale, **{**cloud_options, "exhausted_zones": ()}))
+    provision("warmup", 1)
+    gcp.get_zone_health().forget()
+    cloud = fake_gcp.FakeCloud(time_scale=time_scale, **cloud_options)
+    fake_gcp.install(cloud)
+    tracemalloc.start()
+    durations = []
+    failures = 0
+    try:
+        for _ in range(repeat):
+            with ThreadPoolExecutor(max_workers=users) as executor:
+                for elapsed, succeeded in executor.map(lambda user: provision(user, vm_count), range(users)):
+                    durations.append(elapsed / time_scale)
+                    failures += not succeeded
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    runs = users * repeat
+    return {
+        "vm_count": vm_count,
+        "users": users,
+        "runs": runs,
+        "failures": failures,
+        "p50_s": round(percentile(durations, 0.5), 1),
+        "p95_s": round(percentile(durations, 0.95), 1),
+        "rpcs_per_env": round(sum(cloud.rpc_counts.values()) / runs, 1),
+        "peak_memory_mb": round(peak_memory / 1e6, 2),
+        "rpc_counts": dict(cloud.rpc_counts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vm-counts", default="1,3,5", help="Comma separated numbers of VMs per environment.")
+    parser.add_argument("--users", default="1,4", help="Comma separated numbers of concurrent users.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of rounds per scenario.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean API call latency in seconds.")
+    parser.add_argument("--propagation-delay", type=float, default=5.0, help="Seconds before an enabled API or new resource is visible.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a transient API error.")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="Probability of a RATE_LIMIT_EXCEEDED API error.")
+    parser.add_argument("--lost-response-rate", type=float, default=0.0, help="Probability that a Compute Engine insert is applied but its response lost.")
+    parser.add_argument("--exhausted-zones", default="", help="Comma separated zones out of capacity.")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="Factor applied to every simulated delay.")
+    parser.add_argument("--mode", choices=["concurrent", "bulk"], default=gcp.INSTANCE_CREATION_MODE, help="Instance creation mode.")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per scenario instead of a table.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the messages printed by the provisioning functions.")
+    args = parser.parse_args()
+
+    # The provisioning functions write to a Streamlit page, which does not exist here
+    config.set_option("logger.level", "error")
+    streamlit.logger.set_log_level("error")
+    gcp.INSTANCE_CREATION_MODE = args.mode
+    gcp.READINESS_INITIAL_DELAY *= args.time_scale
+    gcp.READINESS_MAX_DELAY *= args.time_scale
+    gcp.READINESS_DEADLINE *= args.time_scale
+    gcp.OPERATION_POLL_INITIAL_INTERVAL *= args.time_scale
+    gcp.OPERATION_POLL_MAX_INTERVAL *= args.time_scale
+    gcp.OPERATION_TIMEOUT *= args.time_scale
+    gcp.RETRY_INITIAL_DELAY *= args.time_scale
+    gcp.RETRY_MAX_DELAY *= args.time_scale
+    gcp.ZONE_FAILURE_MEMORY *= args.time_scale
+    gcp.API_RATE_LIMITS = {family: (rate / args.time_scale, burst) for family, (rate, burst) in gcp.API_RATE_LIMITS.items()}
+    cloud_options = {
+        "latency": args.latency,
+        "propagation_delay": args.propagation_delay,
+        "error_rate": args.error_rate,
+        "quota_error_rate": args.quota_error_rate,
+        "lost_response_rate": args.lost_response_rate,
+        "exhausted_zones": [value for value in args.exhausted_zones.split(",") if value],
+    }
+
+    if not args.json:
+        print(f"{'VMs':>4} {'users':>5} {'runs':>5} {'failed':>6} {'p50 (s)':>8} {'p95 (s)':>8} {'RPCs/env':>9} {'peak MB':>8}")
+    for vm_count in [int(value) for value in args.vm_counts.split(",")]:
+        for users in [int(value) for value in args.users.split(",")]:
+            with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+                result = run_scenario(vm_count, users, args.repeat, cloud_options, args.time_scale)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{result['vm_count']:>4} {result['users']:>5} {result['runs']:>5} {result['failures']:>6} {result['p50_s']:>8} {result['p95_s']:>8} {result['rpcs_per_env']:>9} {result['peak_memory_mb']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,3 +11,16 @@
 # Depolying app from source code
 #gcloud run deploy simple-app --source . --region=$LOCATION --project=$PROJECT --allow-unauthenticated
 gcloud run deploy simple-app --source . --region=us-central1 --project=YOUR-PROJECT-ID --allow-unauthenticated 
+
+
+# Persistent job state: STATE_DB_PATH defaults to /tmp, which Cloud Run keeps in memory and drops with
+# the instance, so jobs interrupted by an instance recycle are lost. To resume them, keep the SQLite
+# database on a Filestore (NFS) share. A single instance writes to it, SQLite cannot be shared by
+# several instances over NFS. The share must be reachable from the VPC network given below.
+#FILESTORE_IP=10.0.0.2
+#FILESTORE_SHARE=/state
+#gcloud run deploy simple-app --source . --region=$LOCATION --project=$PROJECT --allow-unauthenticated \
+#    --execution-environment=gen2 --max-instances=1 --network=default --subnet=default \
+#    --add-volume=name=state,type=nfs,location=$FILESTORE_IP:$FILESTORE_SHARE \
+#    --add-volume-mount=volume=state,mount-path=/mnt/state \
+#    --set-env-vars=STATE_DB_PATH=/mnt/state/py-instances.db
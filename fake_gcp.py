@@ -0,0 +1,561 @@
+"""
+Offline stand-ins for the Google Cloud clients used by gcp.py.
+
+FakeCloud keeps the state of projects, services, networks, instances and
+buckets in memory and answers each call after a configurable latency. Long
+running operations complete after a configurable duration, and calls can fail
+at random with transient errors or quota errors. install() plugs the fakes
+into the client registry of gcp.py, so the real provisioning code runs
+against them with no network access.
+"""
+import contextlib
+import datetime
+import itertools
+import random
+import re
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from google.api_core import exceptions
+from google.cloud import compute_v1
+from google.cloud import service_usage_v1
+
+import gcp
+
+DEFAULT_OPERATION_DURATIONS = {
+    "project": 20.0,
+    "enable_service": 30.0,
+    "network": 15.0,
+    "subnetwork": 10.0,
+    "instance": 40.0,
+    "stockout": 5.0,  # Instance creation failing because its zone is out of capacity
+    "delete": 20.0,
+}  # Seconds, before time_scale is applied
+
+
+class FakeCloud:
+    """
+    In-memory Google Cloud with simulated latency, operation durations and failures.
+
+    Args:
+        latency: Mean duration of an API call in seconds.
+        operation_durations: Duration in seconds of each kind of long running operation (see DEFAULT_OPERATION_DURATIONS).
+        propagation_delay: Seconds between an operation completing and its result being visible to readiness checks.
+        error_rate: Probability that an API call fails with a transient ServiceUnavailable error.
+        quota_error_rate: Probability that an API call fails with a RATE_LIMIT_EXCEEDED quota error.
+        lost_response_rate: Probability that a Compute Engine insert is applied but fails with a ServiceUnavailable error, as if its response was lost.
+        time_scale: Factor applied to every latency and duration, e.g. 0.01 to run a 5 minute flow in 3 seconds.
+        exhausted_zones: Zones out of capacity, where instance creations fail with ZONE_RESOURCE_POOL_EXHAUSTED.
+        seed: Seed of the random generator, for reproducible runs.
+    """
+
+    def __init__(self, latency=0.2, operation_durations=None, propagation_delay=5.0, error_rate=0.0, quota_error_rate=0.0, lost_response_rate=0.0, time_scale=1.0, seed=None, exhausted_zones=()):
+        self.latency = latency
+        self.operation_durations = {**DEFAULT_OPERATION_DURATIONS, **(operation_durations or {})}
+        self.propagation_delay = propagation_delay
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+        self.lost_response_rate = lost_response_rate
+        self.time_scale = time_scale
+        self.exhausted_zones = set(exhausted_zones)
+        self.rpc_counts = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._project_numbers = itertools.count(100000000001)
+        self._operation_ids = itertools.count(1)
+        self.folders = {}  # parent -> list of (display name, name)
+        self.projects = {}  # project ID -> project number
+        self.project_details = {}  # project ID -> (parent, labels, creation time)
+        self.services = {}  # project ID -> time the Compute Engine API is visible as enabled
+        self.networks = set()  # (project ID, network name)
+        self.subnetworks = set()  # (project ID, region, subnetwork name)
+        self.instances = {}  # (project ID, zone, instance name) -> time the instance is running
+        self.buckets = {}  # bucket name -> project ID
+        self.blobs = {}  # bucket name -> set of object names
+        self.operations = {}  # operation name -> (done time, error)
+        self.request_ids = {}  # request ID of a Compute Engine insert -> name of its operation
+        self._effects = []  # (done time, callable) applied once their operation is done
+        parent = gcp.ORGANIZATION_ID
+        for index, display_name in enumerate(gcp.TARGET_FOLDER_PATH):
+            self.folders[parent] = [(display_name, f"folders/{index + 1}")]
+            parent = f"folders/{index + 1}"
+
+    def rpc(self, name):
+        """Counts an API call, waits for its latency and raises the simulated failures."""
+        with self._lock:
+            self.rpc_counts[name] += 1
+            draw = self._random.random()
+            delay = self._random.uniform(0.5, 1.5) * self.latency * self.time_scale
+        time.sleep(delay)
+        self.settle()
+        if draw < self.quota_error_rate:
+            raise exceptions.TooManyRequests(f"RATE_LIMIT_EXCEEDED: Quota exceeded for {name}")
+        if draw < self.quota_error_rate + self.error_rate:
+            raise exceptions.ServiceUnavailable(f"Simulated transient error on {name}")
+
+    def now(self):
+        return time.monotonic()
+
+    def settle(self):
+        """Applies the effects of the operations that are done."""
+        now = self.now()
+        with self._lock:
+            due = [effect for effect in self._effects if effect[0] <= now]
+            self._effects = [effect for effect in self._effects if effect[0] > now]
+            for _, effect in due:
+                effect()
+
+    def start_operation(self, kind, on_done=None, error=None):
+        """Registers a long running operation of the given kind, whose on_done effect applies once it is done, and returns its name."""
+        done_at = self.now() + self.operation_durations[kind] * self.time_scale
+        with self._lock:
+            name = f"operation-{next(self._operation_ids)}"
+            self.operations[name] = (done_at, error)
+            if on_done is not None and not error:
+                self._effects.append((done_at, on_done))
+        return name
+
+    def insert_once(self, request, insert):
+        """
+        Applies a Compute Engine insert, returning the operation of the first request with the same request ID instead if there is one.
+
+        insert is called without arguments and returns the operation of the insert.
+        """
+        with self._lock:
+            name = self.request_ids.get(request.request_id) if request.request_id else None
+        if name is None:
+            name = insert().name
+            with self._lock:
+                if request.request_id:
+                    self.request_ids[request.request_id] = name
+                lost = self._random.random() < self.lost_response_rate
+            if lost:
+                raise exceptions.ServiceUnavailable(f"Simulated lost response of {name}")
+        return self.compute_operation(name)
+
+    def compute_operation(self, name):
+        """Returns the current state of a Compute Engine operation."""
+        self.settle()
+        done_at, error = self.operations[name]
+        operation = compute_v1.Operation(name=name, status=compute_v1.Operation.Status.RUNNING)
+        if self.now() >= done_at:
+            operation.status = compute_v1.Operation.Status.DONE
+            if error:
+                operation.error = compute_v1.Error(errors=[compute_v1.Errors(code=error, message=error)])
+        return operation
+
+    def wait_compute_operation(self, name, timeout):
+        """Blocks until a Compute Engine operation is done or timeout seconds have passed, like operations.wait."""
+        done_at, _ = self.operations[name]
+        time.sleep(max(0.0, min(done_at - self.now(), timeout * self.time_scale)))
+        return self.compute_operation(name)
+
+    def delete_compute_resource(self, resources, key):
+        """Starts the deletion of a Compute Engine resource from resources (a set or dict) and returns its operation."""
+        if key not in resources:
+            raise exceptions.NotFound(f"Resource {key[-1]} not found")
+
+        def deleted():
+            with self._lock:
+                resources.discard(key) if isinstance(resources, set) else resources.pop(key, None)
+        return self.compute_operation(self.start_operation("delete", on_done=deleted))
+
+    def visible_after(self):
+        """Returns the time at which a change made now becomes visible to readiness checks."""
+        return self.now() + self.propagation_delay * self.time_scale
+
+
+class _LongRunningOperation:
+    """google.api_core.operation.Operation stand-in for resourcemanager and serviceusage."""
+
+    def __init__(self, cloud, name, response):
+        self._cloud = cloud
+        self._name = name
+        self._response = response
+
+    def done(self):
+        self._cloud.settle()
+        return self._cloud.now() >= self._cloud.operations[self._name][0]
+
+    def result(self, timeout=None):
+        done_at, error = self._cloud.operations[self._name]
+        time.sleep(max(0.0, done_at - self._cloud.now()))
+        self._cloud.settle()
+        if error:
+            raise exceptions.GoogleAPICallError(error)
+        return self._response
+
+
+class FakeFoldersClient:
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def list_folders(self, request=None, **kwargs):
+        self._cloud.rpc("folders.list_folders")
+        return [SimpleNamespace(display_name=display_name, name=name) for display_name, name in self._cloud.folders.get(request.parent, [])]
+
+
+class FakeProjectsClient:
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def create_project(self, project=None, **kwargs):
+        cloud = self._cloud
+        cloud.rpc("projects.create_project")
+        with cloud._lock:
+            if project.project_id in cloud.projects:
+                raise exceptions.AlreadyExists(f"Project {project.project_id} already exists")
+            number = next(cloud._project_numbers)
+        response = SimpleNamespace(project_id=project.project_id, name=f"projects/{number}")
+
+        def created():
+            with cloud._lock:
+                cloud.projects[project.project_id] = number
+                cloud.project_details[project.project_id] = (project.parent, dict(project.labels), datetime.datetime.now(datetime.timezone.utc))
+        return _LongRunningOperation(cloud, cloud.start_operation("project", on_done=created), response)
+
+    def get_project(self, name=None, **kwargs):
+        self._cloud.rpc("projects.get_project")
+        project_id = name.split("/")[1]
+        if project_id not in self._cloud.projects:
+            raise exceptions.NotFound(f"Project {project_id} not found")
+        parent, labels, _ = self._cloud.project_details[project_id]
+        return SimpleNamespace(project_id=project_id, name=f"projects/{self._cloud.projects[project_id]}", parent=parent, labels=labels)
+
+    def update_project(self, project=None, update_mask=None, **kwargs):
+        cloud = self._cloud
+        cloud.rpc("projects.update_project")
+        project_id = project.name.split("/")[1]
+
+        def updated():
+            with cloud._lock:
+                if project_id in cloud.project_details and "labels" in update_mask.paths:
+                    parent, _, create_time = cloud.project_details[project_id]
+                    cloud.project_details[project_id] = (parent, dict(project.labels), create_time)
+        return _LongRunningOperation(cloud, cloud.start_operation("project", on_done=updated), project)
+
+    def list_projects(self, parent=None, **kwargs):
+        self._cloud.rpc("projects.list_projects")
+        return [
+            SimpleNamespace(project_id=project_id, name=f"projects/{self._cloud.projects[project_id]}", labels=labels, create_time=create_time)
+            for project_id, (project_parent, labels, create_time) in sorted(self._cloud.project_details.items()) if project_parent == parent
+        ]
+
+    def delete_project(self, name=None, **kwargs):
+        cloud = self._cloud
+        cloud.rpc("projects.delete_project")
+        project_id = name.split("/")[1]
+        if project_id not in cloud.projects:
+            raise exceptions.NotFound(f"Project {project_id} not found")
+
+        def deleted():
+            with cloud._lock:
+                cloud.projects.pop(project_id, None)
+                cloud.project_details.pop(project_id, None)
+        return _LongRunningOperation(cloud, cloud.start_operation("delete", on_done=deleted), None)
+
+
+class FakeBillingClient:
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def update_project_billing_info(self, name=None, project_billing_info=None, **kwargs):
+        self._cloud.rpc("billing.update_project_billing_info")
+        return project_billing_info
+
+
+class FakeServiceUsageClient:
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def get_service(self, request=None, **kwargs):
+        self._cloud.rpc("service_usage.get_service")
+        project_id = request.name.split("/")[1]
+        enabled = self._cloud.now() >= self._cloud.services.get(project_id, float("inf"))
+        return SimpleNamespace(name=request.name, state=service_usage_v1.State.ENABLED if enabled else service_usage_v1.State.DISABLED)
+
+    def enable_service(self, request=None, **kwargs):
+        cloud = self._cloud
+        cloud.rpc("service_usage.enable_service")
+        project_id = request.name.split("/")[1]
+
+        def enabled():
+            with cloud._lock:
+                cloud.services[project_id] = cloud.visible_after()
+        return _LongRunningOperation(cloud, cloud.start_operation("enable_service", on_done=enabled), SimpleNamespace(name=request.name))
+
+
+class FakeComputeProjectsClient:
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def get(self, project=None, **kwargs):
+        self._cloud.rpc("compute_projects.get")
+        if self._cloud.now() < self._cloud.services.get(project, float("inf")):
+            raise exceptions.Forbidden(f"Compute Engine API has not been used in project {project}")
+        return SimpleNamespace(name=project, default_service_account=f"{self._cloud.projects[project]}-compute@developer.gserviceaccount.com")
+
+
+class FakeNetworksClient:
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def get(self, project=None, network=None, **kwargs):
+        self._cloud.rpc("networks.get")
+        if (project, network) not in self._cloud.networks:
+            raise exceptions.NotFound(f"Network {network} not found")
+        return compute_v1.Network(name=network)
+
+    def list(self, project=None, **kwargs):
+        self._cloud.rpc("networks.list")
+        return [compute_v1.Network(name=name) for network_project, name in sorted(self._cloud.networks) if network_project == project]
+
+    def insert(self, request=None, **kwargs):
+        cloud = self._cloud
+        cloud.rpc("networks.insert")
+        key = (request.project, request.network_resource.name)
+
+        def created():
+            with cloud._lock:
+                cloud.networks.add(key)
+
+        def insert():
+            if key in cloud.networks:
+                raise exceptions.Conflict(f"The resource '{request.network_resource.name}' already exists")
+            return cloud.compute_operation(cloud.start_operation("network", on_done=created))
+        return cloud.insert_once(request, insert)
+
+    def delete(self, project=None, network=None, **kwargs):
+        self._cloud.rpc("networks.delete")
+        return self._cloud.delete_compute_resource(self._cloud.networks, (project, network))
+
+
+class FakeSubnetworksClient:
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def get(self, project=None, region=None, subnetwork=None, **kwargs):
+        self._cloud.rpc("subnetworks.get")
+        if subnetwork is None or (project, region, subnetwork) not in self._cloud.subnetworks:
+            raise exceptions.NotFound(f"Subnetwork {subnetwork} not found")
+        return compute_v1.Subnetwork(name=subnetwork, region=region)
+
+    def list(self, project=None, region=None, **kwargs):
+        self._cloud.rpc("subnetworks.list")
+        return [compute_v1.Subnetwork(name=name, region=subnet_region) for subnet_project, subnet_region, name in sorted(self._cloud.subnetworks) if subnet_project == project and subnet_region == region]
+
+    def insert(self, request=None, **kwargs):
+        cloud = self._cloud
+        cloud.rpc("subnetworks.insert")
+        key = (request.project, request.region, request.subnetwork_resource.name)
+
+        def created():
+            with cloud._lock:
+                cloud.subnetworks.add(key)
+
+        def insert():
+            if key in cloud.subnetworks:
+                raise exceptions.Conflict(f"The resource '{request.subnetwork_resource.name}' already exists")
+            return cloud.compute_operation(cloud.start_operation("subnetwork", on_done=created))
+        return cloud.insert_once(request, insert)
+
+    def delete(self, project=None, region=None, subnetwork=None, **kwargs):
+        self._cloud.rpc("subnetworks.delete")
+        return self._cloud.delete_compute_resource(self._cloud.subnetworks, (project, region, subnetwork))
+
+
+class FakeInstancesClient:
+    def __init__(self, cloud):
+        self._cloud = cloud
+
+    def get(self, project=None, zone=None, instance=None, **kwargs):
+        self._cloud.rpc("instances.get")
+        if (project, zone, instance) not in self._cloud.instances:
+            raise exceptions.NotFound(f"Instance {instance} not found")
+        return compute_v1.Instance(name=instance, zone=zone, status="RUNNING")
+
+    def list(self, project=None, zone=None, **kwargs):
+        self._cloud.rpc("instances.list")
+        request = kwargs.get("request")
+        if request is not None:
+            project, zone = request.project, request.zone
+        # Supports the 'name eq "<regex>"' filters only
+        name_filter = re.fullmatch(r'name eq "(.*)"', request.filter) if request is not None and request.filter else None
+        return [
+            compute_v1.Instance(name=name, zone=instance_zone, status="RUNNING")
+            for instance_project, instance_zone, name in sorted(self._cloud.instances)
+            if instance_project == project and instance_zone == zone and (name_filter is None or re.fullmatch(name_filter.group(1), name))
+        ]
+
+    def aggregated_list(self, request=None, **kwargs):
+        self._cloud.rpc("instances.aggregated_list")
+        scopes = {}
+        for instance_project, instance_zone, name in sorted(self._cloud.instances):
+            if instance_project == request.project:
+                interface = compute_v1.NetworkInterface(network_i_p=f"172.18.100.{len(scopes.get(f'zones/{instance_zone}', [])) + 2}")
+                scopes.setdefault(f"zones/{instance_zone}", []).append(compute_v1.Instance(name=name, zone=instance_zone, status="RUNNING", network_interfaces=[interface]))
+        return [(scope, SimpleNamespace(instances=instances)) for scope, instances in scopes.items()]
+
+    def _create(self, project, zone, names):
+        cloud = self._cloud
+
+        def created():
+            with cloud._lock:
+                for name in names:
+                    cloud.instances[(project, zone, name)] = cloud.now()
+        if zone in cloud.exhausted_zones:
+            return cloud.compute_operation(cloud.start_operation("stockout", error="ZONE_RESOURCE_POOL_EXHAUSTED"))
+        return cloud.compute_operation(cloud.start_operation("instance", on_done=created))
+
+    def insert(self, request=None, **kwargs):
+        self._cloud.rpc("instances.insert")
+
+        def insert():
+            if (request.project, request.zone, request.instance_resource.name) in self._cloud.instances:
+                raise exceptions.Conflict(f"The resource '{request.instance_resource.name}' already exists")
+            return self._create(request.project, request.zone, [request.instance_resource.name])
+        return self._cloud.insert_once(request, insert)
+
+    def delete(self, project=None, zone=None, instance=None, **kwargs):
+        self._cloud.rpc("instances.delete")
+        return self._cloud.delete_compute_resource(self._cloud.instances, (project, zone, instance))
+
+    def bulk_insert(self, request=None, **kwargs):
+        self._cloud.rpc("instances.bulk_insert")
+        resource = request.bulk_insert_instance_resource_resource
+        digits = resource.name_pattern.count("#")
+        prefix = resource.name_pattern.rstrip("#")
+
+        def insert():
+            # Like Compute Engine, skip the names already in use; the numbers it picks are not documented, take any free ones
+            existing = {name for instance_project, _, name in self._cloud.instances if instance_project == request.project}
+            free = [name for name in (f"{prefix}{i:0{digits}d}" for i in range(1, 10 ** digits)) if name not in existing]
+            names = self._cloud._random.sample(free, resource.count)
+            return self._create(request.project, request.zone, names)
+        return self._cloud.insert_once(request, insert)
+
+
+class FakeOperationsClient:
+    """Global, regional and zonal operations clients."""
+
+    def __init__(self, cloud, scope):
+        self._cloud = cloud
+        self._scope = scope
+
+    def wait(self, operation=None, timeout=None, **kwargs):
+        self._cloud.rpc(f"{self._scope}_operations.wait")
+        return self._cloud.wait_compute_operation(operation, timeout or 120)
+
+    def get(self, operation=None, **kwargs):
+        self._cloud.rpc(f"{self._scope}_operations.get")
+        return self._cloud.compute_operation(operation)
+
+    def aggregated_list(self, request=None, **kwargs):
+        self._cloud.rpc(f"{self._scope}_operations.aggregated_list")
+        names = re.findall(r'name = "([^"]+)"', request.filter)
+        operations = [self._cloud.compute_operation(name) for name in names if name in self._cloud.operations]
+        return [("global", SimpleNamespace(operations=operations))]
+
+
+class _FakeBucket:
+    def __init__(self, client, name):
+        self._client = client
+        self.name = name
+        self.location = None
+        self.storage_class = None
+        self.iam_configuration = SimpleNamespace(uniform_bucket_level_access_enabled=False)
+        self.lifecycle_rules = []
+
+    def add_lifecycle_delete_rule(self, **kwargs):
+        self.lifecycle_rules.append({"action": {"type": "Delete"}, "condition": kwargs})
+
+    @property
+    def project_number(self):
+        cloud = self._client._cloud
+        return cloud.projects.get(cloud.buckets.get(self.name))
+
+    def delete_blob(self, blob_name, **kwargs):
+        cloud = self._client._cloud
+        if self._client._batch is None:
+            cloud.rpc("storage.delete_blob")
+        with cloud._lock:
+            cloud.blobs.get(self.name, set()).discard(blob_name)
+
+    def delete(self, **kwargs):
+        cloud = self._client._cloud
+        cloud.rpc("storage.delete_bucket")
+        with cloud._lock:
+            if self.name not in cloud.buckets:
+                raise exceptions.NotFound(f"Bucket {self.name} not found")
+            if cloud.blobs.get(self.name):
+                raise exceptions.Conflict(f"Bucket {self.name} is not empty")
+            del cloud.buckets[self.name]
+            cloud.blobs.pop(self.name, None)
+
+
+class FakeStorageClient:
+    def __init__(self, cloud):
+        self._cloud = cloud
+        self._batch = None
+
+    @contextlib.contextmanager
+    def batch(self, raise_exception=True):
+        """Sends the deletions made in the block as a single call."""
+        self._cloud.rpc("storage.batch")
+        self._batch = []
+        try:
+            yield
+        finally:
+            self._batch = None
+
+    def bucket(self, bucket_name):
+        return _FakeBucket(self, bucket_name)
+
+    def create_bucket(self, bucket, project=None, **kwargs):
+        self._cloud.rpc("storage.create_bucket")
+        with self._cloud._lock:
+            if bucket.name in self._cloud.buckets:
+                raise exceptions.Conflict(f"Bucket {bucket.name} already exists")
+            self._cloud.buckets[bucket.name] = project
+        return bucket
+
+    def get_bucket(self, bucket_name, **kwargs):
+        self._cloud.rpc("storage.get_bucket")
+        if bucket_name not in self._cloud.buckets:
+            raise exceptions.NotFound(f"Bucket {bucket_name} not found")
+        return _FakeBucket(self, bucket_name)
+
+    def list_blobs(self, bucket_name, page_size=1000, **kwargs):
+        cloud = self._cloud
+        cloud.rpc("storage.list_blobs")
+        if bucket_name not in cloud.buckets:
+            raise exceptions.NotFound(f"Bucket {bucket_name} not found")
+        names = sorted(cloud.blobs.get(bucket_name, ()))
+        pages = [[SimpleNamespace(name=name) for name in names[index:index + page_size]] for index in range(0, len(names), page_size)]
+        return SimpleNamespace(pages=pages)
+
+
+def client_factories(cloud):
+    """Returns client factories for gcp.ClientRegistry that create fakes backed by cloud."""
+    return {
+        "projects": lambda: FakeProjectsClient(cloud),
+        "folders": lambda: FakeFoldersClient(cloud),
+        "billing": lambda: FakeBillingClient(cloud),
+        "service_usage": lambda: FakeServiceUsageClient(cloud),
+        "networks": lambda: FakeNetworksClient(cloud),
+        "subnetworks": lambda: FakeSubnetworksClient(cloud),
+        "instances": lambda: FakeInstancesClient(cloud),
+        "compute_projects": lambda: FakeComputeProjectsClient(cloud),
+        "global_operations": lambda: FakeOperationsClient(cloud, "global"),
+        "region_operations": lambda: FakeOperationsClient(cloud, "region"),
+        "zone_operations": lambda: FakeOperationsClient(cloud, "zone"),
+        "storage": lambda: FakeStorageClient(cloud),
+    }
+
+
+def install(cloud):
+    """Makes gcp.get_client return fakes backed by cloud, and drops the clients created so far."""
+    gcp.get_client_registry().replace_factories(client_factories(cloud))
+    gcp.invalidate_folder_cache()
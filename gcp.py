@@ -1,26 +1,647 @@
-from google.cloud import billing_v1
-from google.cloud import resourcemanager_v3
-from google.cloud.resourcemanager_v3 import types
-from google.cloud import compute_v1
-from google.cloud import service_usage_v1
-from google.api_core import operation
-from google.cloud import storage
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from collections import Counter, deque
+from contextlib import closing, contextmanager
+from dataclasses import asdict, dataclass, field, is_dataclass
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import base64
+import contextvars
+import functools
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import math
 import uuid
 import os
 import random
+import re
+import sqlite3
+import threading
 import time
 import streamlit as st
 
+class _LazyModule:
+    """
+    Stands for a module that is imported the first time one of its attributes is used.
+
+    The Google Cloud client libraries take seconds to import, so the page is
+    rendered without them and each one is loaded by the first step that calls it.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+billing_v1 = _LazyModule("google.cloud.billing_v1")
+resourcemanager_v3 = _LazyModule("google.cloud.resourcemanager_v3")
+types = _LazyModule("google.cloud.resourcemanager_v3.types")
+compute_v1 = _LazyModule("google.cloud.compute_v1")
+service_usage_v1 = _LazyModule("google.cloud.service_usage_v1")
+operation = _LazyModule("google.api_core.operation")
+exceptions = _LazyModule("google.api_core.exceptions")
+storage = _LazyModule("google.cloud.storage")
+field_mask_pb2 = _LazyModule("google.protobuf.field_mask_pb2")
+google_crc32c = _LazyModule("google_crc32c")
+
 BILLING_ACCOUNT_ID = "billingAccounts/015F68-XXXX-XXXXX"  # Replace with your actual billing account ID - new format
 TARGET_FOLDER_PATH = ["FOLDER", "SUBFOLDER"]  # Define the path to the target folder.
 ORGANIZATION_ID = "organizations/XXXXX"  # Replace with your actual organization id
 zone = "us-central1-c"  # Replace with your desired zone
+zones = [zone, "us-central1-a", "us-central1-b", "us-central1-f"]  # Zones the VMs are spread over, in the region; VMs go to the other ones when a zone is out of capacity
 region = "us-central1"  # Replace with your desired region
 source_image = "projects/YOUR-PROJECT_ID/global/images/SOURCE-IMAGE-NAME"  # Replace with your source image
 network_name = "NAME-custom-vpc"
 subnet_name = "subnet1"
 ip_range = "172.18.100.0/24"
 win_startup_script = "gs://YOUR-BUCKET-NAME/ps-disk.ps1" # Modify to use your own GCS bucket
+MAX_CONCURRENT_INSERTS = 5  # Maximum number of instance inserts in flight at the same time
+UPLOAD_MAX_WORKERS = 8  # Maximum number of files or file parts uploaded at the same time
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Resumable upload chunk size, must be a multiple of 256 KiB
+COMPOSITE_UPLOAD_THRESHOLD = 256 * 1024 * 1024  # Files larger than this are uploaded as parallel parts then composed
+COMPOSITE_PART_SIZE = 64 * 1024 * 1024  # Minimum size of a part of a composite upload
+UPLOAD_PARTS_PREFIX = ".parts/"  # Prefix of the parts of composite uploads, kept until they are composed
+UPLOAD_PARTS_MAX_AGE_DAYS = 7  # Days after which the bucket deletes the parts left by an abandoned upload
+FOLDER_CACHE_TTL = 3600  # Seconds a resolved folder path is reused before listing the folders again
+READINESS_DEADLINE = 180  # Maximum number of seconds to wait for an API, service account or subnet to become usable
+READINESS_INITIAL_DELAY = 1  # Seconds between the first two readiness checks, doubled after each check
+READINESS_MAX_DELAY = 15  # Maximum number of seconds between two readiness checks
+OPERATION_POLL_INITIAL_INTERVAL = 1  # Seconds before the first poll of a long running operation, increased by half after each poll
+OPERATION_POLL_MAX_INTERVAL = 10  # Maximum number of seconds between two polls of a long running operation
+OPERATION_POLL_WORKERS = 4  # Threads polling the long running operations of every session
+OPERATION_TIMEOUT = 900  # Seconds after which a long running operation still running is reported as failed
+API_RATE_LIMITS = {  # (calls per second, burst) allowed per API family, shared by every session of the process
+    "resourcemanager": (5, 10),
+    "billing": (5, 10),
+    "serviceusage": (2, 5),
+    "compute": (20, 40),
+    "storage": (50, 100),
+}
+RETRY_MAX_ATTEMPTS = 6  # Maximum number of attempts of an API call failing with a quota or availability error
+RETRY_INITIAL_DELAY = 1  # Upper bound in seconds of the first retry delay, doubled after each attempt
+RETRY_MAX_DELAY = 32  # Maximum upper bound in seconds of a retry delay
+RETRY_BUDGET_RATIO = 0.1  # Retries earned by each API call
+RETRY_BUDGET_MAX = 20  # Retries that can be saved up in the retry budget, which starts full
+WARM_POOL_SIZE = 0  # Number of prepared projects (without VMs) kept ready for new environments, 0 disables the warm pool
+WARM_POOL_CHECK_INTERVAL = 60  # Seconds between two checks of the warm pool size
+WARM_POOL_MAX_BACKOFF = 3600  # Maximum number of seconds between two checks after failed preparations, the interval doubling after each failed round
+WARM_POOL_MAX_FAILED_ROUNDS = 5  # Consecutive rounds of failed preparations after which the warm pool stops creating projects until the next restart
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "/tmp/py-instances.db")  # SQLite database holding the app state, on a mounted volume (see deploy.sh) for jobs to survive a Cloud Run instance recycle
+JOB_MAX_WORKERS = 4  # Maximum number of environments provisioned at the same time by the job queue
+JOB_POLL_INTERVAL = 5  # Seconds between two refreshes of the job status on the page
+PROJECT_ID_ATTEMPTS = 3  # Project IDs tried by a job whose generated ID is already used by another project
+TRACE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)  # Upper bounds in seconds of the latency histogram buckets
+TRACE_MAX_SPANS = 10000  # Number of most recent spans kept in memory
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH")  # If set, every span is appended to this file as a JSON line
+ENVIRONMENT_LABEL = "py-instances"  # Value of the "created-by" label of the projects created by this app
+ENVIRONMENT_TTL_HOURS = 72  # Hours after which an environment is deleted by the expired environments sweep
+TEARDOWN_SWEEP_INTERVAL = 0  # Seconds between two sweeps of the expired environments, 0 disables the sweep
+TEARDOWN_MAX_WORKERS = 8  # Maximum number of environments, or of resources of one kind, deleted at the same time
+BACKGROUND_START_DELAY = 5  # Seconds between the first page load and the start of the background work (folder cache, warm pool, sweep, job resumption)
+INVENTORY_TTL = 30  # Seconds the bucket and VMs of an environment are shown before being listed again
+INVENTORY_PROJECTS_TTL = 300  # Seconds the environments of a user are shown before the projects are listed again
+INVENTORY_MAX_WORKERS = 8  # Maximum number of environments listed at the same time
+INVENTORY_POLL_INTERVAL = 10  # Seconds between two refreshes of the VM list on the page
+ZONE_FAILURE_MEMORY = 900  # Seconds a zone out of capacity is avoided when placing new VMs
+INSTANCE_CREATION_MODE = "concurrent"  # "concurrent" (one insert per VM) or "bulk" (a single bulk insert for all the VMs)
+
+@dataclass
+class Span:
+    """A timed provisioning step, API call or operation wait."""
+    name: str
+    kind: str  # "step", "rpc", "wait", "throttle" or "retry"
+    tags: dict
+    start: float = 0.0
+    duration: float = 0.0
+    outcome: str = "ok"
+    error: str = None
+
+class Tracer:
+    """
+    Records spans and aggregates them into latency histograms and counters.
+
+    Spans are tagged with the tags of the enclosing traced() blocks (e.g. trace, project, zone).
+    The tags live in a context variable owned by the tracer: Streamlit executes this file
+    again on each rerun, and a module-level variable would differ from the one read by
+    the objects cached by an earlier run.
+    """
+
+    def __init__(self, buckets=TRACE_BUCKETS, max_spans=TRACE_MAX_SPANS, log_path=TRACE_LOG_PATH):
+        self.tags = contextvars.ContextVar("trace_tags", default={})
+        self.buckets = tuple(buckets)
+        self.log_path = log_path
+        self._spans = deque(maxlen=max_spans)
+        self._histograms = {}
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, kind="step", **tags):
+        """Times the enclosed block as a span; an exception marks it as an error and is re-raised."""
+        span = Span(name, kind, {**self.tags.get(), **tags}, start=time.time())
+        started = time.monotonic()
+        try:
+            yield span
+        except BaseException as e:
+            span.outcome = "error"
+            span.error = str(e)
+            raise
+        finally:
+            span.duration = time.monotonic() - started
+            self.record(span)
+
+    def record(self, span):
+        """Adds a finished span to the histograms, counters and span log."""
+        with self._lock:
+            self._spans.append(span)
+            histogram = self._histograms.setdefault((span.name, span.kind), {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for index, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += span.duration
+            histogram["count"] += 1
+            self._counters[(span.name, span.kind, span.outcome)] += 1
+            if self.log_path:
+                with open(self.log_path, "a") as log:
+                    log.write(json.dumps(asdict(span)) + "\n")
+
+    def spans(self, **tags):
+        """Returns the recorded spans whose tags include the given tags."""
+        with self._lock:
+            return [span for span in self._spans if all(span.tags.get(key) == value for key, value in tags.items())]
+
+    def export_prometheus(self):
+        """Returns the histograms and counters in the Prometheus text exposition format."""
+        lines = [
+            "# HELP provisioning_span_duration_seconds Duration of provisioning steps, API calls and operation waits.",
+            "# TYPE provisioning_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            for (name, kind), histogram in sorted(self._histograms.items()):
+                labels = f'name="{name}",kind="{kind}"'
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f'provisioning_span_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'provisioning_span_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+                lines.append(f"provisioning_span_duration_seconds_sum{{{labels}}} {histogram['sum']}")
+                lines.append(f"provisioning_span_duration_seconds_count{{{labels}}} {histogram['count']}")
+            lines.append("# HELP provisioning_spans_total Number of spans per outcome.")
+            lines.append("# TYPE provisioning_spans_total counter")
+            for (name, kind, outcome), count in sorted(self._counters.items()):
+                lines.append(f'provisioning_spans_total{{name="{name}",kind="{kind}",outcome="{outcome}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def export_jsonl(self, **tags):
+        """Returns the recorded spans whose tags include the given tags, one JSON object per line."""
+        return "".join(json.dumps(asdict(span)) + "\n" for span in self.spans(**tags))
+
+@st.cache_resource
+def get_tracer():
+    """Returns the tracer of the process."""
+    return Tracer()
+
+@contextmanager
+def traced(**tags):
+    """Adds tags (e.g. trace, project, zone) to every span recorded in the enclosed block, including in _submit workers."""
+    current = get_tracer().tags
+    token = current.set({**current.get(), **tags})
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+def _submit(executor, fn, *args):
+    """Submits fn to an executor with the trace tags of the caller."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def _st_thread_pool(max_workers):
+    """
+    Creates a thread pool whose workers can write to the current Streamlit page.
+
+    Args:
+        max_workers: The maximum number of worker threads.
+
+    Returns:
+        A concurrent.futures.ThreadPoolExecutor.
+    """
+    return ThreadPoolExecutor(
+        max_workers=max_workers, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())
+    )
+
+_CLIENT_FACTORIES = {
+    "projects": lambda: resourcemanager_v3.ProjectsClient(),
+    "folders": lambda: resourcemanager_v3.FoldersClient(),
+    "billing": lambda: billing_v1.CloudBillingClient(),
+    "service_usage": lambda: service_usage_v1.ServiceUsageClient(),
+    "networks": lambda: compute_v1.NetworksClient(),
+    "subnetworks": lambda: compute_v1.SubnetworksClient(),
+    "instances": lambda: compute_v1.InstancesClient(),
+    "compute_projects": lambda: compute_v1.ProjectsClient(),
+    "global_operations": lambda: compute_v1.GlobalOperationsClient(),
+    "region_operations": lambda: compute_v1.RegionOperationsClient(),
+    "zone_operations": lambda: compute_v1.ZoneOperationsClient(),
+    "storage": lambda: storage.Client(),
+}
+
+_API_FAMILIES = {
+    "projects": "resourcemanager",
+    "folders": "resourcemanager",
+    "billing": "billing",
+    "service_usage": "serviceusage",
+    "networks": "compute",
+    "subnetworks": "compute",
+    "instances": "compute",
+    "compute_projects": "compute",
+    "global_operations": "compute",
+    "region_operations": "compute",
+    "zone_operations": "compute",
+    "storage": "storage",
+}
+
+class TokenBucket:
+    """Lets through up to burst calls at once, then rate calls per second."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting for one if the bucket is empty, and returns the number of seconds waited."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token now so that waiting callers are served in order
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of the calls, so that an outage does not turn into a retry storm.
+
+    Each call deposits ratio of a retry, each retry withdraws one. The budget starts
+    with, and never holds more than, capacity retries.
+    """
+
+    def __init__(self, ratio, capacity):
+        self.ratio = ratio
+        self.capacity = capacity
+        self._balance = capacity
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.capacity, self._balance + self.ratio)
+
+    def withdraw(self):
+        """Returns True and takes a retry from the budget if one is left."""
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+def _is_retryable(error):
+    """Whether an API error is a quota or availability error worth retrying."""
+    if isinstance(error, (exceptions.TooManyRequests, exceptions.ResourceExhausted, exceptions.ServiceUnavailable)):
+        return True
+    # Compute Engine reports exceeded rate quotas as 403 errors
+    return isinstance(error, exceptions.GoogleAPICallError) and ("RATE_LIMIT_EXCEEDED" in str(error) or "rateLimitExceeded" in str(error))
+
+class ApiRateLimiter:
+    """
+    Shares the API quotas of the process between every session and thread.
+
+    Calls go through a token bucket per API family (API_RATE_LIMITS). Quota and
+    availability errors are retried with exponential backoff and full jitter, as
+    long as the shared retry budget allows it. Throttle waits are recorded as
+    "throttle" spans and retries as "retry" spans.
+    """
+
+    def __init__(self, limits=None, max_attempts=None, initial_delay=None, max_delay=None, budget=None):
+        limits = API_RATE_LIMITS if limits is None else limits
+        self.buckets = {family: TokenBucket(rate, burst) for family, (rate, burst) in limits.items()}
+        self.max_attempts = RETRY_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.initial_delay = RETRY_INITIAL_DELAY if initial_delay is None else initial_delay
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+        self.budget = budget or RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX)
+
+    def call(self, kind, name, fn):
+        """
+        Calls fn() within the rate limit of the API family of a client kind, retrying quota and availability errors.
+
+        Args:
+            kind: The client kind (a key of _CLIENT_FACTORIES).
+            name: The name of the rpc span of each attempt (e.g. "instances.insert").
+            fn: The API call.
+
+        Returns:
+            The return value of fn.
+        """
+        family = _API_FAMILIES.get(kind, kind)
+        bucket = self.buckets.get(family)
+        tracer = get_tracer()
+        self.budget.deposit()
+        for attempt in range(1, self.max_attempts + 1):
+            if bucket is not None:
+                started = time.time()
+                waited = bucket.acquire()
+                if waited:
+                    tracer.record(Span(family, "throttle", dict(tracer.tags.get()), start=started, duration=waited))
+            try:
+                with tracer.span(name, kind="rpc"):
+                    return fn()
+            except Exception as e:
+                if not _is_retryable(e) or attempt == self.max_attempts:
+                    raise
+                if not self.budget.withdraw():
+                    tracer.record(Span(name, "retry", dict(tracer.tags.get()), start=time.time(), outcome="error", error="Retry budget exhausted"))
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.initial_delay * 2 ** (attempt - 1)))
+                tracer.record(Span(name, "retry", dict(tracer.tags.get()), start=time.time(), duration=delay, error=str(e)))
+                time.sleep(delay)
+
+@st.cache_resource
+def get_rate_limiter():
+    """Returns the API rate limiter of the process."""
+    return ApiRateLimiter()
+
+class _InstrumentedClient:
+    """
+    Wraps a client so that each of its API calls goes through the rate limiter
+    and is recorded as an "rpc" span named "<kind>.<method>".
+
+    The later pages of the pagers returned by list methods are fetched the same way.
+    """
+
+    _LOCAL_METHODS = {"bucket", "batch"}  # Methods that do not call the API
+
+    def __init__(self, kind, client):
+        self._kind = kind
+        self._client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith("_") or name in self._LOCAL_METHODS or not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            result = get_rate_limiter().call(self._kind, f"{self._kind}.{name}", lambda: attribute(*args, **kwargs))
+            return self._instrument_pages(result, f"{self._kind}.{name}")
+        return call
+
+    def _instrument_pages(self, result, name):
+        """Routes the page requests of a pager (GAPIC pagers call _method, storage iterators api_request) through the rate limiter."""
+        if not hasattr(result, "pages"):
+            return result
+        for attribute in ("_method", "api_request"):
+            fetch = getattr(result, attribute, None)
+            if callable(fetch):
+                setattr(result, attribute, functools.partial(self._fetch_page, fetch, name))
+        return result
+
+    def _fetch_page(self, fetch, name, *args, **kwargs):
+        return get_rate_limiter().call(self._kind, name, lambda: fetch(*args, **kwargs))
+
+class ClientRegistry:
+    """
+    Lazily created Google Cloud clients, shared by every session, rerun and thread of the process.
+
+    Each client is created on first use and reused afterwards, so credentials and
+    transports are set up once per process instead of once per call. Clients are
+    instrumented so that every API call is traced.
+    """
+
+    def __init__(self, factories):
+        self._factories = dict(factories)
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.created = Counter()
+        self.reused = Counter()
+
+    def get(self, kind):
+        """Returns the client registered under kind, creating it on first use."""
+        with self._lock:
+            client = self._clients.get(kind)
+            if client is None:
+                client = _InstrumentedClient(kind, self._factories[kind]())
+                self._clients[kind] = client
+                self.created[kind] += 1
+            else:
+                self.reused[kind] += 1
+            return client
+
+    def create(self, kind):
+        """Creates a client for kind that is not shared, for callers that change the state of their client (e.g. storage batches)."""
+        with self._lock:
+            factory = self._factories[kind]
+            self.created[kind] += 1
+        return _InstrumentedClient(kind, factory())
+
+    def replace_factories(self, factories):
+        """Swaps the client factories (e.g. for offline fakes) and drops the clients created so far."""
+        with self._lock:
+            self._factories = dict(factories)
+            self._clients.clear()
+
+    def stats(self):
+        """Returns the number of clients created and reused, per kind."""
+        with self._lock:
+            return {kind: {"created": self.created[kind], "reused": self.reused[kind]} for kind in self._factories}
+
+@st.cache_resource
+def get_client_registry():
+    """Returns the client registry of the process."""
+    return ClientRegistry(_CLIENT_FACTORIES)
+
+def get_client(kind):
+    """
+    Returns the shared client for an API.
+
+    Args:
+        kind: One of the keys of _CLIENT_FACTORIES (e.g. "projects", "instances", "storage").
+    """
+    return get_client_registry().get(kind)
+
+@dataclass
+class _TrackedOperation:
+    """An operation registered with the OperationTracker."""
+    operation: object
+    project: str
+    name: str
+    future: Future
+    tags: dict
+    start: float
+    started: float
+    deadline: float
+    next_poll: float
+    interval: float
+
+class OperationTracker:
+    """
+    Waits for long running operations on behalf of every caller of the process.
+
+    Callers register their operations and get a Future instead of blocking a thread
+    in their own wait loop. A few polling threads check the pending operations:
+    Compute Engine operations with one aggregated list call per project, whatever
+    their number and scope, and the other operations (resource manager, service
+    usage) with done(). The interval between two polls of an operation grows from
+    initial_interval to max_interval while it runs, and the time each operation
+    took is recorded as a "wait" span.
+    """
+
+    _BATCH_SIZE = 50  # Maximum number of operation names in one list filter
+
+    def __init__(self, initial_interval=None, max_interval=None, timeout=None, workers=OPERATION_POLL_WORKERS):
+        self.initial_interval = OPERATION_POLL_INITIAL_INTERVAL if initial_interval is None else initial_interval
+        self.max_interval = OPERATION_POLL_MAX_INTERVAL if max_interval is None else max_interval
+        self.timeout = OPERATION_TIMEOUT if timeout is None else timeout
+        self._workers = workers
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def track(self, operation, project=None, name="operation.wait"):
+        """
+        Registers an operation to wait for.
+
+        Args:
+            operation: A Compute Engine operation, or a google.api_core operation.
+            project: The project of a Compute Engine operation.
+            name: The name of the wait span recorded when the operation finishes.
+
+        Returns:
+            A Future resolved with the finished Compute Engine operation (whose error
+            field the caller checks), or with the result of the google.api_core operation.
+        """
+        now = time.monotonic()
+        tracked = _TrackedOperation(
+            operation, project, name, Future(), dict(get_tracer().tags.get()), time.time(), now,
+            now + self.timeout, now + self.initial_interval, self.initial_interval,
+        )
+        if hasattr(operation, "status") and operation.status == compute_v1.Operation.Status.DONE:
+            self._finish(tracked, operation)
+            return tracked.future
+        if hasattr(operation, "status") and project is None:
+            raise ValueError(f"The project of operation {operation.name} is required to track it.")
+        with self._condition:
+            self._pending.append(tracked)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="operation-tracker", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return tracked.future
+
+    def pending(self):
+        """Returns the number of operations still running."""
+        with self._condition:
+            return len(self._pending)
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="operation-poll") as executor:
+            while True:
+                with self._condition:
+                    while not self._pending:
+                        self._condition.wait()
+                    now = time.monotonic()
+                    due = [tracked for tracked in self._pending if tracked.next_poll <= now]
+                    if not due:
+                        self._condition.wait(min(tracked.next_poll for tracked in self._pending) - now)
+                        continue
+                    # The other Compute Engine operations of the same projects come for free in the same calls
+                    projects = {tracked.project for tracked in due if hasattr(tracked.operation, "status")}
+                    due = [tracked for tracked in self._pending if tracked.next_poll <= now or tracked.project in projects and hasattr(tracked.operation, "status")]
+                    self._pending = [tracked for tracked in self._pending if tracked not in due]
+                batches = {}
+                for tracked in due:
+                    if hasattr(tracked.operation, "status"):
+                        batches.setdefault(tracked.project, []).append(tracked)
+                    else:
+                        batches[id(tracked)] = [tracked]
+                polls = []
+                for batch in batches.values():
+                    for index in range(0, len(batch), self._BATCH_SIZE):
+                        polls.append(executor.submit(self._poll, batch[index:index + self._BATCH_SIZE]))
+                still_running = [tracked for poll in polls for tracked in poll.result()]
+                now = time.monotonic()
+                for tracked in still_running:
+                    if now >= tracked.deadline:
+                        self._finish(tracked, error=ValueError(f"Operation {tracked.operation.name} still running after {self.timeout}s."))
+                        continue
+                    tracked.interval = min(tracked.interval * 1.5, self.max_interval)
+                    tracked.next_poll = now + tracked.interval
+                with self._condition:
+                    self._pending.extend(tracked for tracked in still_running if not tracked.future.done())
+
+    def _poll(self, batch):
+        """Checks a batch of operations, finishes those that are done and returns the others."""
+        try:
+            if not hasattr(batch[0].operation, "status"):
+                tracked = batch[0]
+                if not tracked.operation.done():
+                    return batch
+                try:
+                    self._finish(tracked, tracked.operation.result())
+                except Exception as e:
+                    self._finish(tracked, error=e)
+                return []
+            # One call for all the operations of the project, global, regional and zonal
+            names = {tracked.operation.name: tracked for tracked in batch}
+            request = compute_v1.AggregatedListGlobalOperationsRequest(
+                project=batch[0].project, filter=" OR ".join(f'(name = "{name}")' for name in names)
+            )
+            finished = {}
+            for _, scoped_list in get_client("global_operations").aggregated_list(request=request):
+                for operation in scoped_list.operations:
+                    if operation.name in names and operation.status == compute_v1.Operation.Status.DONE:
+                        finished[operation.name] = operation
+            for name, operation in finished.items():
+                self._finish(names[name], operation)
+            return [tracked for name, tracked in names.items() if name not in finished]
+        except Exception as e:
+            # Polling errors are retried at the next poll, until the deadline
+            print(f"Could not poll {len(batch)} operations: {e}")
+            return batch
+
+    def _finish(self, tracked, result=None, error=None):
+        span = Span(tracked.name, "wait", tracked.tags, start=tracked.start, duration=time.monotonic() - tracked.started)
+        if error is not None:
+            span.outcome = "error"
+            span.error = str(error)
+            tracked.future.set_exception(error)
+        else:
+            tracked.future.set_result(result)
+        get_tracer().record(span)
+
+@st.cache_resource
+def get_operation_tracker():
+    """Returns the operation tracker of the process."""
+    return OperationTracker()
+
+def wait_for_operation(operation, name, project=None):
+    """
+    Blocks until a long running operation is done, using the shared operation tracker.
+
+    Args:
+        operation: A Compute Engine operation, or a google.api_core operation.
+        name: The name of the wait span (e.g. "network.create.wait").
+        project: The project of a Compute Engine operation.
+
+    Returns:
+        The finished Compute Engine operation, or the result of the google.api_core operation.
+    """
+    return get_operation_tracker().track(operation, project, name).result()
 
 def find_folder_id_recursive(folder_client, parent, folder_path):
     """
@@ -56,39 +677,133 @@ def find_folder_id_recursive(folder_client, parent, folder_path):
 #    print(f"Folder '{current_folder_name}' not found under '{parent}'")  # Debugging
     return None  # Folder not found at this level.
 
-def create_project_in_folder(project_id):
-    """Creates a Google Cloud project inside a specific folder and attaches a billing account."""
+@st.cache_resource
+def _folder_cache():
+    """Folder path -> (folder ID, expiry time) entries shared by every session of the process."""
+    return {"lock": threading.Lock(), "entries": {}}
 
-    project_client = resourcemanager_v3.ProjectsClient()
-    billing_client = billing_v1.CloudBillingClient()
-    folder_client = resourcemanager_v3.FoldersClient()
+def resolve_folder_id(folder_client, folder_path, ttl=FOLDER_CACHE_TTL):
+    """
+    Finds the folder ID of a folder path, using the process-wide folder cache.
 
-    # Start the search from the organization
-    st.markdown(f"**Starting project creation for project ID: {project_id}**")
-#    print(f"Starting project creation for project ID: {project_id}")  # Debugging
-#    print(f"Using organization ID: {ORGANIZATION_ID}")  # Debugging
-    folder_full_id = find_folder_id_recursive(folder_client, ORGANIZATION_ID, TARGET_FOLDER_PATH)
+    Args:
+        folder_client: The resourcemanager_v3.FoldersClient, only used on a cache miss.
+        folder_path: A list of folder names under the organization (e.g., ["FOLDER", "SUBFOLDER"]).
+        ttl: The number of seconds a resolved folder ID stays in the cache.
 
-    if folder_full_id is None:
-        raise ValueError(f"Folder path '{TARGET_FOLDER_PATH}' not found.")
-#    print(f"Found folder ID: {folder_full_id}")  # Debugging
+    Returns:
+        The folder ID (full resource name) if found, otherwise None.
+    """
+    cache = _folder_cache()
+    key = tuple(folder_path)
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+    if entry is not None and entry[1] > time.monotonic():
+        return entry[0]
 
-    project = resourcemanager_v3.Project()
-    project.project_id = project_id
-    project.display_name = project_id
-    project.parent = folder_full_id # new code
-    operation = project_client.create_project(project=project)
+    folder_id = find_folder_id_recursive(folder_client, ORGANIZATION_ID, folder_path)
+    if folder_id is not None:
+        with cache["lock"]:
+            cache["entries"][key] = (folder_id, time.monotonic() + ttl)
+    return folder_id
+
+def invalidate_folder_cache(folder_path=None):
+    """
+    Removes a folder path from the folder cache.
+
+    Args:
+        folder_path: The folder path to forget, or None to empty the whole cache.
+    """
+    cache = _folder_cache()
+    with cache["lock"]:
+        if folder_path is None:
+            cache["entries"].clear()
+        else:
+            cache["entries"].pop(tuple(folder_path), None)
 
+def warm_folder_cache(folder_path=TARGET_FOLDER_PATH):
+    """Resolves the target folder path ahead of the first project creation."""
     try:
-        response = operation.result()
-        # Get the project number from the response
-        project_number = response.name.split('/')[1]
+        resolve_folder_id(get_client("folders"), folder_path)
     except Exception as e:
-        raise ValueError(f"An error occurred during the project creation: {e}")
+        print(f"Could not warm the folder cache for '{folder_path}': {e}")
+
+def _is_stale_parent_error(error):
+    """Tells whether a project creation error means the cached parent folder no longer exists."""
+    if isinstance(error, exceptions.NotFound):
+        return True
+    return isinstance(error, (exceptions.InvalidArgument, exceptions.FailedPrecondition)) and "parent" in str(error).lower()
+
+class ProjectIdTakenError(ValueError):
+    """The project ID is used by a project that was not created by this provisioning."""
+
+def create_project(project_id, folder_full_id=None, labels=None):
+    """
+    Creates a Google Cloud project inside the target folder.
+
+    A project that already exists is only taken over if it is in the folder and carries
+    the same "creation-id" label, i.e. it was created by an earlier run of the same provisioning.
+
+    Args:
+        project_id: The ID of the project.
+        folder_full_id: The folder ID (full resource name) to create the project in, resolved from TARGET_FOLDER_PATH if None.
+        labels: The labels of the project (e.g. from environment_labels).
+
+    Returns:
+        A dict with the project ID and project number.
+
+    Raises:
+        ProjectIdTakenError: If the ID is used by another project, or was used by a deleted one.
+    """
+    project_client = get_client("projects")
+    folder_client = get_client("folders")
+
+    for attempt in range(2):
+        if folder_full_id is None:
+            folder_full_id = resolve_folder_id(folder_client, TARGET_FOLDER_PATH)
+
+        if folder_full_id is None:
+            raise ValueError(f"Folder path '{TARGET_FOLDER_PATH}' not found.")
+#        print(f"Found folder ID: {folder_full_id}")  # Debugging
+
+        project = resourcemanager_v3.Project()
+        project.project_id = project_id
+        project.display_name = project_id
+        project.parent = folder_full_id # new code
+        project.labels = labels or {}
+
+        try:
+            operation = project_client.create_project(project=project)
+            response = wait_for_operation(operation, "project.create.wait")
+            # Get the project number from the response
+            project_number = response.name.split('/')[1]
+            break
+        except exceptions.AlreadyExists:
+            # Created by an earlier, interrupted run, or the generated ID collides with another project
+            creation_id = (labels or {}).get("creation-id")
+            try:
+                response = project_client.get_project(name=f"projects/{project_id}")
+            except (exceptions.PermissionDenied, exceptions.NotFound):
+                raise ProjectIdTakenError(f"Project ID {project_id} is already used outside of this app.")
+            if creation_id is None or response.parent != folder_full_id or response.labels.get("creation-id") != creation_id:
+                raise ProjectIdTakenError(f"Project ID {project_id} is already used by another project.")
+            project_number = response.name.split('/')[1]
+            break
+        except Exception as e:
+            if attempt == 0 and _is_stale_parent_error(e):
+                # The cached folder ID is stale, resolve the folder path again and retry once
+                invalidate_folder_cache(TARGET_FOLDER_PATH)
+                folder_full_id = None
+                continue
+            raise ValueError(f"An error occurred during the project creation: {e}")
     st.success(f"Project {response.project_id} created successfully", icon="✅")
     #print(f"Project created successfully : {response.project_id}")  # Debugging
     #print(f"Your Project number is : {project_number}")
+    return {"project_id": response.project_id, "project_number": project_number}
 
+def attach_billing_account(project_id):
+    """Attaches BILLING_ACCOUNT_ID to the project."""
+    billing_client = get_client("billing")
     project_name = f"projects/{project_id}"
 
     # Set Billing account
@@ -101,7 +816,17 @@ def create_project_in_folder(project_id):
 #        print(f"Billing account attached successfully to {project_name}")
     except Exception as e:
         raise ValueError(f"An error occurred when attaching the billing account: {e}")
-    return {"project_id": response.project_id, "project_number": project_number}
+
+def create_project_in_folder(project_id):
+    """Creates a Google Cloud project inside a specific folder and attaches a billing account."""
+
+    # Start the search from the organization
+    st.markdown(f"**Starting project creation for project ID: {project_id}**")
+#    print(f"Starting project creation for project ID: {project_id}")  # Debugging
+#    print(f"Using organization ID: {ORGANIZATION_ID}")  # Debugging
+    response = create_project(project_id)
+    attach_billing_account(project_id)
+    return response
 
 def generate_unique_project_id(name_project):
     """Generates a unique project ID."""
@@ -110,7 +835,7 @@ def generate_unique_project_id(name_project):
 def enable_compute_engine_api(project_id):
     """Enables the Compute Engine API for the specified project."""
 
-    service_client = service_usage_v1.ServiceUsageClient()
+    service_client = get_client("service_usage")
     service_name = f"projects/{project_id}/services/compute.googleapis.com"
 
     try:
@@ -127,93 +852,207 @@ def enable_compute_engine_api(project_id):
 
         st.markdown(f"**Enabling Compute Engine API for project: {project_id}**")
         #print(f"Enabling Compute Engine API for project: {project_id}...")
-        response = operation.result()  # Wait for the operation to complete
+        response = wait_for_operation(operation, "compute_api.enable.wait")  # Wait for the operation to complete
         st.success(f"Compute Engine API enabled successfully for project: {project_id}", icon="✅")
         return response
 
     except Exception as e:
         raise ValueError(f"Error enabling Compute Engine API: {e}")
 
-def create_custom_vpc_with_subnet(project_id, region):
+def wait_until_ready(check, description, deadline=None, initial_delay=None, max_delay=None):
+    """
+    Polls a readiness check with exponential backoff and jitter until it passes.
+
+    API errors raised by the check (e.g. not found or permission denied while a
+    change propagates) count as "not ready yet".
+
+    Args:
+        check: A callable returning True once the resource is usable.
+        description: What is being waited for, used in messages.
+        deadline: The maximum number of seconds to wait, READINESS_DEADLINE if None.
+        initial_delay: The delay in seconds before the second check, READINESS_INITIAL_DELAY if None.
+        max_delay: The upper bound of the delay between two checks, READINESS_MAX_DELAY if None.
+
+    Returns:
+        The number of seconds actually waited.
+    """
+    with get_tracer().span(f"ready.{description}", kind="wait"):
+        return _poll_until_ready(
+            check, description,
+            READINESS_DEADLINE if deadline is None else deadline,
+            READINESS_INITIAL_DELAY if initial_delay is None else initial_delay,
+            READINESS_MAX_DELAY if max_delay is None else max_delay,
+        )
+
+def _poll_until_ready(check, description, deadline, initial_delay, max_delay):
+    """Polling loop of wait_until_ready."""
+    start = time.monotonic()
+    delay = initial_delay
+    last_error = None
+    while True:
+        try:
+            if check():
+                waited = time.monotonic() - start
+                print(f"{description} ready after {waited:.1f}s")
+                return waited
+        except exceptions.GoogleAPICallError as e:
+            last_error = e
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            raise ValueError(f"{description} not ready after {deadline}s: {last_error}")
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(delay * 2, max_delay)
+
+def compute_api_ready(project_id):
+    """Tells whether the Compute Engine API reports ENABLED for the project."""
+    service = get_client("service_usage").get_service(
+        request=service_usage_v1.GetServiceRequest(name=f"projects/{project_id}/services/compute.googleapis.com")
+    )
+    return service.state == service_usage_v1.State.ENABLED
+
+def service_account_ready(project_id, service_account_email):
+    """Tells whether Compute Engine reports service_account_email as the default service account of the project."""
+    project = get_client("compute_projects").get(project=project_id)
+    return project.default_service_account == service_account_email
+
+def subnet_ready(project_id, region):
+    """Tells whether the subnet of the environment can be read in the region."""
+    get_client("subnetworks").get(project=project_id, region=region, subnetwork=subnet_name)
+    return True
+
+@dataclass
+class ProjectState:
+    """Compute Engine resources found in a project by fetch_project_state."""
+    networks: list  # Network names
+    subnetworks: list  # Subnet names in the region
+    instances: dict  # Instance name -> zone
+
+def fetch_project_state(project_id, region):
+    """
+    Lists the networks, subnets and instances of a project, whatever their number, in three API calls.
+
+    Errors (e.g. permission denied) are raised, they are never mistaken for missing resources.
+
+    Args:
+        project_id: The ID of the project.
+        region: The region of the subnets to list.
+
+    Returns:
+        A ProjectState.
+    """
+    networks = [network.name for network in get_client("networks").list(project=project_id)]
+    subnetworks = [subnetwork.name for subnetwork in get_client("subnetworks").list(project=project_id, region=region)]
+    instances = {}
+    request = compute_v1.AggregatedListInstancesRequest(project=project_id)
+    for scope, scoped_list in get_client("instances").aggregated_list(request=request):
+        for instance in scoped_list.instances:
+            instances[instance.name] = scope.rsplit("/", 1)[-1]
+    return ProjectState(networks, subnetworks, instances)
+
+@dataclass
+class EnvironmentPlan:
+    """What needs creating in a project to reach the desired environment."""
+    create_network: bool
+    create_subnet: bool
+    instances_to_create: list
+    existing_instances: dict  # Instance name -> zone
+
+def plan_environment(state, instance_names=()):
+    """
+    Compares the current state of a project with the desired environment.
+
+    Args:
+        state: The ProjectState returned by fetch_project_state.
+        instance_names: The names of the VMs the environment should have.
+
+    Returns:
+        An EnvironmentPlan.
+    """
+    return EnvironmentPlan(
+        create_network=network_name not in state.networks,
+        create_subnet=subnet_name not in state.subnetworks,
+        instances_to_create=[name for name in instance_names if name not in state.instances],
+        existing_instances={name: state.instances[name] for name in instance_names if name in state.instances},
+    )
+
+def create_custom_vpc_with_subnet(project_id, region, state=None):
     """
     Creates a custom VPC network with a subnet in the specified region.
 
+    Only the missing resources are created, so calling it again is cheap.
+
     Args:
         project_id: The ID of the project.
         region: The region in which to create the subnet (default: us-central1).
+        state: The ProjectState of the project, fetched with fetch_project_state if None.
     """
-    network_client = compute_v1.NetworksClient()
-    subnet_client = compute_v1.SubnetworksClient()
+    network_client = get_client("networks")
+    subnet_client = get_client("subnetworks")
 
-    # Check if the network already exists
-    try:
-        network_client.get(
-            project=project_id, network=network_name
-        )
+    if state is None:
+        state = fetch_project_state(project_id, region)
+    plan = plan_environment(state)
+
+    if not plan.create_network:
         print(f"VPC network '{network_name}' already exists in project '{project_id}'.")
-        #check if subnet exists
-        try:
-            subnet_client.get(project=project_id, region=region, subnet=subnet_name)
-            print(f"Subnet '{subnet_name}' already exists in project '{project_id}' region '{region}'.")
-            return
-        except Exception:
-            print(f"Subnet '{subnet_name}' does not exists in project '{project_id}' region '{region}'.")
-    except Exception:
+    else:
        # print(f"VPC network '{network_name}' does not exist in project '{project_id}'. Creating...")
 
         # Create the custom VPC network
         network_body = compute_v1.Network()
         network_body.name = network_name
         network_body.auto_create_subnetworks = False  # We want to create our own subnet
+        # Compute Engine applies an insert once per request ID, so the retries of the rate limiter are safe
         request = compute_v1.InsertNetworkRequest(
-            project=project_id, network_resource=network_body
+            project=project_id, network_resource=network_body, request_id=str(uuid.uuid4())
         )
-        operation = network_client.insert(request=request)
+        try:
+            operation = network_client.insert(request=request)
+        except exceptions.Conflict:
+            print(f"VPC network '{network_name}' already exists in project '{project_id}'.")
+        else:
+            st.markdown(f"**Creating VPC network: {network_name}**")
 
-        st.markdown(f"**Creating VPC network: {network_name}**")
+            # Wait for network creation operation to complete
+            operation = wait_for_operation(operation, "network.create.wait", project_id)
+            if operation.error:
+                raise ValueError(f"An error occured during the creation of the network {network_name}: {operation.error}")
+            st.success(f"VPC network created successfully.", icon="✅")
+            #print(f"VPC network created successfully.")
+
+    if not plan.create_subnet:
+        print(f"Subnet '{subnet_name}' already exists in project '{project_id}' region '{region}'.")
+        return
 
-        # Wait for network creation operation to complete
-        operation_client = compute_v1.GlobalOperationsClient()
-        while operation.status != compute_v1.Operation.Status.DONE:
-            operation = operation_client.wait(
-                project=project_id, operation=operation.name, timeout=300
-            )
-            #print(f"Operation status: {operation.status}")
-        if operation.error:
-            raise ValueError(f"An error occured during the creation of the network {network_name}: {operation.error}")
-        st.success(f"VPC network created successfully.", icon="✅")
-        #print(f"VPC network created successfully.")
-    
     # Create the subnet
     subnet_body = compute_v1.Subnetwork()
     subnet_body.name = subnet_name
     subnet_body.ip_cidr_range = ip_range
     subnet_body.region = region
     subnet_body.network = f"projects/{project_id}/global/networks/{network_name}"  # Link subnet to the network
-    request = compute_v1.InsertSubnetworkRequest(project=project_id, region=region, subnetwork_resource=subnet_body)
-    operation = subnet_client.insert(request=request)
+    request = compute_v1.InsertSubnetworkRequest(project=project_id, region=region, subnetwork_resource=subnet_body, request_id=str(uuid.uuid4()))
+    try:
+        operation = subnet_client.insert(request=request)
+    except exceptions.Conflict:
+        print(f"Subnet '{subnet_name}' already exists in project '{project_id}' region '{region}'.")
+        return
     #st.markdown(f"**Creating Subnet in region {region}**")
 
     # Wait for subnet creation operation to complete
-    operation_client = compute_v1.RegionOperationsClient()
-    while operation.status != compute_v1.Operation.Status.DONE:
-        operation = operation_client.wait(
-            project=project_id, region=region, operation=operation.name, timeout=300
-        )
-        #print(f"Operation status: {operation.status}")
+    operation = wait_for_operation(operation, "subnet.create.wait", project_id)
     if operation.error:
         raise ValueError(f"An error occured during the creation of the subnet {subnet_name}: {operation.error}")
 
     #st.success(f"Subnet created successfully in region '{region}'.", icon="✅")
 
-def create_instance(project_id, zone, service_account_email, instance_name, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type):
+def instance_definition(service_account_email, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type):
     """
-    Creates a Google Compute Engine instance with specified configurations.
+    Builds the instance fields shared by every VM of an environment.
+
+    The result can be passed to compute_v1.Instance or compute_v1.InstanceProperties.
 
     Args:
-        project_id: The ID of the project.
-        zone: The zone in which to create the instance.
-        instance_name: The name of the instance.
+        service_account_email: The service account attached to the instance.
         machine_type: The machine type for the instance.
         subnet_name: The name of the subnet to use.
         source_image: The source image for the boot disk.
@@ -221,19 +1060,10 @@ def create_instance(project_id, zone, service_account_email, instance_name, mach
         disk_type: The type of the boot disk.
         second_disk_size_gb: The size of the second disk in GB.
         second_disk_type: The type of the second disk.
-    """
-    instance_client = compute_v1.InstancesClient()
-    disk_client = compute_v1.DisksClient()
-    zone_operations_client = compute_v1.ZoneOperationsClient()
-
-    # Check if the instance already exists
-    try:
-        instance_client.get(project=project_id, zone=zone, instance=instance_name)
-        print(f"Instance '{instance_name}' already exists in project '{project_id}' zone '{zone}'.")
-        return
-    except Exception:
-        print(f"Instance '{instance_name}' does not exist in project '{project_id}' zone '{zone}'. Creating...")
 
+    Returns:
+        A dict of instance field names to values.
+    """
     # Define the boot disk configuration
     boot_disk = compute_v1.AttachedDisk()
     initialize_params = compute_v1.AttachedDiskInitializeParams()
@@ -244,8 +1074,6 @@ def create_instance(project_id, zone, service_account_email, instance_name, mach
     boot_disk.initialize_params = initialize_params
     boot_disk.auto_delete = True
     boot_disk.boot = True
-    boot_disk.device_name = instance_name
-#    print(f"{boot_disk.device_name}")
 
     # Define the second disk configuration
     second_disk = compute_v1.AttachedDisk()
@@ -253,10 +1081,6 @@ def create_instance(project_id, zone, service_account_email, instance_name, mach
     second_disk.initialize_params.disk_size_gb = second_disk_size_gb
     second_disk.initialize_params.disk_type = second_disk_type
     second_disk.auto_delete = True
-    random_digits = str(random.randint(100, 999))
-    second_disk_name = f"disk-{random_digits}"  # Add the 3-digit number to the disk name
-    second_disk.initialize_params.disk_name = second_disk_name
-#    print(f"{second_disk.device_name}")
 
     # Define the network interface configuration
     print("Define the network interface configuration")
@@ -296,98 +1120,1661 @@ def create_instance(project_id, zone, service_account_email, instance_name, mach
     shielded_instance_config.enable_secure_boot = False
     shielded_instance_config.enable_vtpm = True
 
+    return {
+        "machine_type": machine_type,
+        "disks": [boot_disk, second_disk],
+        "network_interfaces": [network_interface],
+        "service_accounts": [service_account],
+        "metadata": metadata,
+        "shielded_instance_config": shielded_instance_config,
+        "can_ip_forward": False,
+        "confidential_instance_config": compute_v1.ConfidentialInstanceConfig(enable_confidential_compute=False),
+        "key_revocation_action_type": "NONE",
+        "labels": {
+            "goog-ops-agent-policy": "v2-x86-template-1-4-0",
+            "goog-ec-src": "vm_add-rest",
+        },
+        "reservation_affinity": compute_v1.ReservationAffinity(consume_reservation_type="ANY_RESERVATION"),
+        "scheduling": compute_v1.Scheduling(automatic_restart=True, on_host_maintenance="MIGRATE", provisioning_model="STANDARD"),
+        # Add the network tag "rdp"
+        "tags": compute_v1.Tags(items=["rdp"]),
+        "guest_accelerators": [],
+    }
+
+def _zonal_url(project_id, zone, collection, name):
+    """Returns the URL of a zonal resource type (e.g. a machine type) in zone, from its name or its URL in another zone."""
+    return f"projects/{project_id}/zones/{zone}/{collection}/{name.rsplit('/', 1)[-1]}"
+
+def insert_instance(project_id, zone, service_account_email, instance_name, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, check_exists=True):
+    """
+    Sends the creation request of a Google Compute Engine instance, without waiting for it to complete.
+
+    Args:
+        project_id: The ID of the project.
+        zone: The zone in which to create the instance.
+        instance_name: The name of the instance.
+        machine_type: The machine type for the instance, as a name or a URL in any zone.
+        subnet_name: The name of the subnet to use.
+        source_image: The source image for the boot disk.
+        disk_size_gb: The size of the boot disk in GB.
+        disk_type: The type of the boot disk, as a name or a URL in any zone.
+        second_disk_size_gb: The size of the second disk in GB.
+        second_disk_type: The type of the second disk, as a name or a URL in any zone.
+        check_exists: Whether to look the instance up first; False when a preflight already found it missing.
+
+    Returns:
+        None if the instance was already there, otherwise a Future of the creation operation, from the operation tracker.
+    """
+    instance_client = get_client("instances")
+
+    # Check if the instance already exists
+    if check_exists:
+        try:
+            instance_client.get(project=project_id, zone=zone, instance=instance_name)
+            print(f"Instance '{instance_name}' already exists in project '{project_id}' zone '{zone}'.")
+            return None
+        except exceptions.NotFound:
+            print(f"Instance '{instance_name}' does not exist in project '{project_id}' zone '{zone}'. Creating...")
+
+    definition = instance_definition(
+        service_account_email, _zonal_url(project_id, zone, "machineTypes", machine_type), subnet_name, source_image,
+        disk_size_gb, _zonal_url(project_id, zone, "diskTypes", disk_type),
+        second_disk_size_gb, _zonal_url(project_id, zone, "diskTypes", second_disk_type),
+    )
+    definition["disks"][0].device_name = instance_name
+#    print(f"{definition['disks'][0].device_name}")
+    random_digits = str(random.randint(100, 999))
+    second_disk_name = f"disk-{random_digits}"  # Add the 3-digit number to the disk name
+    definition["disks"][1].initialize_params.disk_name = second_disk_name
+
     # Create the instance object
-    instance = compute_v1.Instance()
+    instance = compute_v1.Instance(**definition)
     instance.name = instance_name
-    instance.machine_type = machine_type
-    instance.disks = [boot_disk, second_disk]
-    instance.network_interfaces = [network_interface]
-    instance.service_accounts = [service_account]
-    instance.metadata = metadata
-    instance.shielded_instance_config = shielded_instance_config
-    instance.can_ip_forward = False
-    instance.confidential_instance_config = compute_v1.ConfidentialInstanceConfig(enable_confidential_compute=False)
     instance.deletion_protection = False
     instance.display_device = compute_v1.DisplayDevice(enable_display=False)
-    instance.key_revocation_action_type = "NONE"
-    instance.labels = {
-        "goog-ops-agent-policy": "v2-x86-template-1-4-0",
-        "goog-ec-src": "vm_add-rest",
-    }
-    instance.reservation_affinity = compute_v1.ReservationAffinity(consume_reservation_type="ANY_RESERVATION")
-    instance.scheduling = compute_v1.Scheduling(automatic_restart=True, on_host_maintenance="MIGRATE", provisioning_model="STANDARD")
-    
-    # Add the network tag "rdp"
-    instance.tags = compute_v1.Tags(items=["rdp"])
-
-    instance.guest_accelerators = []
     instance.instance_encryption_key = compute_v1.CustomerEncryptionKey()
     instance.params = compute_v1.InstanceParams(resource_manager_tags={})
     instance.zone = f"projects/{project_id}/zones/{zone}"
 
-    # Create the instance creation request
+    # Create the instance creation request, its request ID makes the retries of the rate limiter safe
     request = compute_v1.InsertInstanceRequest(
-        project=project_id, zone=zone, instance_resource=instance
+        project=project_id, zone=zone, instance_resource=instance, request_id=str(uuid.uuid4())
     )
 
-    # Execute the instance creation request
-    operation = instance_client.insert(request=request)
+    # Execute the instance creation request, a conflict means the instance was created since the preflight
+    try:
+        operation = instance_client.insert(request=request)
+    except exceptions.Conflict:
+        print(f"Instance '{instance_name}' already exists in project '{project_id}' zone '{zone}'.")
+        return None
     print(f"Creating instance {instance_name} in {zone}...")
-    
-    # Wait for the operation to complete.
-    operation_client = compute_v1.ZoneOperationsClient()
-
-    while operation.status != compute_v1.Operation.Status.DONE:
-        operation = operation_client.wait(
-            project=project_id, zone=zone, operation=operation.name, timeout=300
-        )
-        #print(f"Operation status: {operation.status}")
+    return get_operation_tracker().track(operation, project_id, "instance.create.wait")
 
+def _check_instance_operation(instance_name, operation):
+    """Raises ValueError if the creation operation of an instance failed, returns "CREATED" otherwise."""
     if operation.error:
-        st.error(f"Error creating instance:")
-    else:
-        st.success(f"Instance created successfully.", icon="✅")
-        #print(f"Instance {instance_name} created successfully.")
-        #print(f"Instance link: {operation.target_link}")   
-
-def disable():
-    st.session_state.disabled = True
+        raise ValueError(f"An error occured during the creation of the instance {instance_name}: {operation.error}")
+    st.success(f"Instance {instance_name} created successfully.", icon="✅")
+    #print(f"Instance {instance_name} created successfully.")
+    #print(f"Instance link: {operation.target_link}")
+    return "CREATED"
 
-def upload_files_to_bucket(project_id, uploaded_files):
-    storage_client = storage.Client(project=project_id)
-    bucket_name = project_id
+def create_instance(project_id, zone, service_account_email, instance_name, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, check_exists=True):
+    """
+    Creates a Google Compute Engine instance with specified configurations.
+
+    Args:
+        The arguments are the same as for insert_instance.
+
+    Returns:
+        "EXISTS" if the instance was already there, "CREATED" otherwise.
+    """
+    operation = insert_instance(project_id, zone, service_account_email, instance_name, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, check_exists)
+    if operation is None:
+        return "EXISTS"
+    return _check_instance_operation(instance_name, operation.result())
+
+@dataclass
+class InstanceResult:
+    """Outcome of one instance creation in a batch."""
+    name: str
+    status: str
+    error: str = None
+    elapsed: float = 0.0
+    zone: str = None
+
+def create_instances_concurrently(project_id, placement, service_account_email, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, max_workers=MAX_CONCURRENT_INSERTS, check_exists=True, relocate=None):
+    """
+    Creates several instances in parallel.
+
+    The insert requests are sent by up to max_workers threads, and the operation
+    tracker waits for all the creations at once. A failure on one instance does
+    not stop the others.
+
+    Args:
+        project_id: The ID of the project.
+        placement: A dict of instance name -> zone, of the instances to create.
+        service_account_email: The service account attached to the instances.
+        max_workers: The maximum number of inserts in flight at the same time.
+        check_exists: Passed to insert_instance.
+        relocate: Called with the InstanceResult of a failed instance. If it returns a zone, the
+            instance is created again in that zone right away, without waiting for the other instances.
+        The remaining arguments are passed to insert_instance.
+
+    Returns:
+        A list of InstanceResult, in the same order as placement, with the zone of the last attempt
+        and the time from the first insert of the instance to its end, retries included.
+    """
+    instance_names = list(placement)
+    zones = dict(placement)
+
+    def insert(instance_name, zone, check):
+        with traced(instance=instance_name, zone=zone):
+            return insert_instance(project_id, zone, service_account_email, instance_name, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, check_exists=check)
+
+    started = {}  # Instance name -> when its first insert was sent, kept across relocations
+    results = {}
+    pending = {}  # Future of an insert or of its operation -> (instance name, whether it is the operation)
+
+    def timed_insert(instance_name, zone, check):
+        started.setdefault(instance_name, time.monotonic())
+        return insert(instance_name, zone, check)
+
+    with _st_thread_pool(max(1, min(max_workers, len(instance_names)))) as executor:
+        for instance_name in instance_names:
+            pending[_submit(executor, timed_insert, instance_name, zones[instance_name], check_exists)] = (instance_name, False)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                instance_name, is_operation = pending.pop(future)
+                try:
+                    value = future.result()
+                    if not is_operation and value is not None:
+                        pending[value] = (instance_name, True)
+                        continue
+                    status = _check_instance_operation(instance_name, value) if is_operation else "EXISTS"
+                    results[instance_name] = InstanceResult(instance_name, status, elapsed=time.monotonic() - started[instance_name], zone=zones[instance_name])
+                except Exception as e:
+                    result = InstanceResult(instance_name, "FAILED", error=str(e), elapsed=time.monotonic() - started[instance_name], zone=zones[instance_name])
+                    zone = relocate(result) if relocate is not None else None
+                    if zone is None:
+                        results[instance_name] = result
+                    else:
+                        # Looked up by the first attempt, or found missing by a preflight
+                        zones[instance_name] = zone
+                        pending[_submit(executor, timed_insert, instance_name, zone, False)] = (instance_name, False)
+    return [results[instance_name] for instance_name in instance_names]
+
+def bulk_create_instances(project_id, zone, service_account_email, name_pattern, count, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, existing_names=()):
+    """
+    Creates several identical instances with a single bulk insert request.
+
+    The instance definition is built once and every VM is named from name_pattern.
+    The second disk of each VM is named by Compute Engine after its instance.
+
+    Args:
+        project_id: The ID of the project.
+        zone: The zone in which to create the instances.
+        service_account_email: The service account attached to the instances.
+        name_pattern: The instance name pattern, "#" characters are replaced by the VM number (e.g. "instance-user-##").
+        count: The number of instances to create.
+        existing_names: The instances already in the project, whose names Compute Engine skips.
+        The remaining arguments are the same as for create_instance.
+
+    Returns:
+        A list of InstanceResult, one per instance created, named as listed after the creation.
+        If the bulk insert failed, count results named name_pattern.
+    """
+    instance_client = get_client("instances")
+    start = time.monotonic()
+
+    # Instance properties take machine and disk type names rather than zonal URLs
+    definition = instance_definition(service_account_email, machine_type.rsplit("/", 1)[-1], subnet_name, source_image, disk_size_gb, disk_type.rsplit("/", 1)[-1], second_disk_size_gb, second_disk_type.rsplit("/", 1)[-1])
+    bulk_resource = compute_v1.BulkInsertInstanceResource()
+    bulk_resource.count = count
+    bulk_resource.min_count = count
+    bulk_resource.name_pattern = name_pattern
+    bulk_resource.instance_properties = compute_v1.InstanceProperties(**definition)
+
+    # Without a request ID, a retried bulk insert that went through would create count more VMs
+    request = compute_v1.BulkInsertInstanceRequest(
+        project=project_id, zone=zone, bulk_insert_instance_resource_resource=bulk_resource, request_id=str(uuid.uuid4())
+    )
+    operation = instance_client.bulk_insert(request=request)
+    print(f"Creating {count} instances named {name_pattern} in {zone}...")
+
+    operation = wait_for_operation(operation, "instances.bulk_create.wait", project_id)
+
+    elapsed = time.monotonic() - start
+    if operation.error:
+        # min_count equals count, so the bulk insert either creates every VM or none of them
+        return [InstanceResult(name_pattern, "FAILED", error=str(operation.error), elapsed=elapsed, zone=zone) for _ in range(count)]
+
+    # Compute Engine picks the numbers of the new instances, read their names instead of guessing them
+    name_regex = re.escape(name_pattern.rstrip("#")) + f"[0-9]{{{name_pattern.count('#')}}}"
+    request = compute_v1.ListInstancesRequest(project=project_id, zone=zone, filter=f'name eq "{name_regex}"')
+    existing_names = set(existing_names)
+    instance_names = sorted(instance.name for instance in instance_client.list(request=request) if re.fullmatch(name_regex, instance.name) and instance.name not in existing_names)
+    st.success(f"{count} instances created successfully.", icon="✅")
+    return [InstanceResult(name, "CREATED", elapsed=elapsed, zone=zone) for name in instance_names]
+
+class ZoneHealth:
+    """Remembers the zones that recently ran out of capacity, for every session of the process."""
+
+    def __init__(self, memory=None):
+        self.memory = ZONE_FAILURE_MEMORY if memory is None else memory
+        self._failures = {}  # Zone -> time of its last capacity error
+        self._lock = threading.Lock()
+
+    def record_failure(self, zone):
+        with self._lock:
+            self._failures[zone] = time.monotonic()
+
+    def forget(self):
+        """Forgets every capacity error, e.g. between two benchmark scenarios."""
+        with self._lock:
+            self._failures.clear()
+
+    def available(self, candidates):
+        """
+        Returns the candidate zones without a recent capacity error, in order.
+
+        If every zone had one, they are all returned, the least recently failed first.
+        """
+        now = time.monotonic()
+        with self._lock:
+            failures = {zone: self._failures[zone] for zone in candidates if now - self._failures.get(zone, -math.inf) < self.memory}
+        healthy = [zone for zone in candidates if zone not in failures]
+        return healthy or sorted(candidates, key=failures.get)
+
+@st.cache_resource
+def get_zone_health():
+    """Returns the zone health of the process."""
+    return ZoneHealth()
+
+def _is_capacity_error(error):
+    """Whether an instance creation error means that the zone is out of capacity (a stockout)."""
+    return any(code in str(error) for code in ("ZONE_RESOURCE_POOL_EXHAUSTED", "does not have enough resources available"))
+
+def place_instances(instance_names, candidates):
+    """
+    Spreads instances over zones, round robin.
+
+    Args:
+        instance_names: The names of the instances.
+        candidates: The zones to use, in order of preference.
+
+    Returns:
+        A dict of instance name -> zone.
+    """
+    return {name: candidates[index % len(candidates)] for index, name in enumerate(instance_names)}
+
+def create_instances_across_zones(project_id, candidates, service_account_email, instance_names, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, check_exists=True):
+    """
+    Creates instances spread over several zones, moving the ones hit by a stockout to other zones.
+
+    As soon as the creation of an instance fails because its zone is out of
+    capacity, the instance is created again in a zone it has not tried yet,
+    while the other creations go on. Such zones are avoided by later placements
+    for ZONE_FAILURE_MEMORY seconds.
+
+    Args:
+        project_id: The ID of the project.
+        candidates: The zones to use, in order of preference.
+        service_account_email: The service account attached to the instances.
+        instance_names: The names of the instances to create.
+        The remaining arguments are passed to insert_instance.
+
+    Returns:
+        A list of InstanceResult, in the same order as instance_names.
+    """
+    health = get_zone_health()
+    placement = place_instances(instance_names, health.available(candidates))
+    tried = {name: {zone} for name, zone in placement.items()}
+    moves = itertools.count()
+
+    def relocate(result):
+        if not _is_capacity_error(result.error):
+            return None
+        health.record_failure(result.zone)
+        remaining = [zone for zone in health.available(candidates) if zone not in tried[result.name]] or [zone for zone in candidates if zone not in tried[result.name]]
+        if not remaining:
+            return None
+        # Spread the moved instances over the remaining zones
+        zone = remaining[next(moves) % len(remaining)]
+        tried[result.name].add(zone)
+        print(f"Retrying instance {result.name}, out of capacity in {result.zone}, in {zone}")
+        return zone
+
+    return create_instances_concurrently(project_id, placement, service_account_email, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, check_exists=check_exists, relocate=relocate)
+
+def bulk_create_instances_across_zones(project_id, candidates, service_account_email, name_pattern, count, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, existing_names=()):
+    """
+    Creates instances with a single bulk insert, in the first zone of candidates with enough capacity.
+
+    Args:
+        candidates: The zones to use, in order of preference.
+        The remaining arguments are the same as for bulk_create_instances.
+
+    Returns:
+        A list of InstanceResult, as returned by bulk_create_instances.
+    """
+    health = get_zone_health()
+    for bulk_zone in health.available(candidates):
+        with traced(zone=bulk_zone):
+            results = bulk_create_instances(project_id, bulk_zone, service_account_email, name_pattern, count, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, existing_names)
+        if not (results and results[0].status == "FAILED" and _is_capacity_error(results[0].error)):
+            return results
+        health.record_failure(bulk_zone)
+        print(f"Zone {bulk_zone} is out of capacity for {count} instances")
+    return results
+
+def create_environment_instances(project_id, name_project, vm_count, service_account_email, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, state=None, candidates=None):
+    """
+    Creates the VMs of an environment with the INSTANCE_CREATION_MODE strategy.
+
+    Instance names are derived from the project ID, so running this again for the
+    same project finds the VMs already created instead of adding new ones.
+
+    Args:
+        state: The ProjectState of the project, each instance is looked up before its creation if None.
+        candidates: The zones to use, in order of preference, zones if None.
+        The remaining arguments are the same as for create_instance.
+
+    Returns:
+        A list of InstanceResult, one per VM.
+    """
+    candidates = candidates or zones
+    if INSTANCE_CREATION_MODE == "bulk":
+        # Create all the missing instances with a single request
+        name_pattern = f"instance-{name_project}-{uuid.uuid5(uuid.NAMESPACE_DNS, project_id).hex[:4]}-##"
+        if state is None:
+            state = fetch_project_state(project_id, region)
+        prefix = name_pattern.rstrip("#")
+        existing = [InstanceResult(name, "EXISTS", zone=state.instances[name]) for name in sorted(state.instances) if name.startswith(prefix)][:vm_count]
+        if len(existing) == vm_count:
+            return existing
+        return existing + bulk_create_instances_across_zones(project_id, candidates, service_account_email, name_pattern, vm_count - len(existing), machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, existing_names=state.instances)
+    # Create all the instances at the same time
+    instance_names = [f"instance-{name_project}-{i}-{uuid.uuid5(uuid.NAMESPACE_DNS, f'{project_id}/{i}').hex[:4]}" for i in range(vm_count)]  # Unique instance names
+    if state is None:
+        return create_instances_across_zones(project_id, candidates, service_account_email, instance_names, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type)
+    plan = plan_environment(state, instance_names)
+    for name in plan.existing_instances:
+        print(f"Instance '{name}' already exists in project '{project_id}' zone '{plan.existing_instances[name]}'.")
+    results = {name: InstanceResult(name, "EXISTS", zone=instance_zone) for name, instance_zone in plan.existing_instances.items()}
+    if plan.instances_to_create:
+        created = create_instances_across_zones(project_id, candidates, service_account_email, plan.instances_to_create, machine_type, subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, check_exists=False)
+        results.update((result.name, result) for result in created)
+    return [results[name] for name in instance_names]
+
+@dataclass
+class ProvisioningStep:
+    """A provisioning step and the names of the steps it needs results from."""
+    name: str
+    run: object  # Called with a dict of dependency name -> result
+    depends_on: tuple = ()
+    resumable: bool = True  # False for snapshots (e.g. "preflight") that must be taken again when a run is resumed
+
+@dataclass
+class StepTiming:
+    """When a step ran and how it ended ("DONE", "FAILED" or "SKIPPED")."""
+    name: str
+    status: str
+    start: float = 0.0
+    end: float = 0.0
+    error: str = None
+    exception: Exception = field(default=None, repr=False)  # The exception of a failed step, for callers that handle some of them
+
+    @property
+    def elapsed(self):
+        return self.end - self.start
+
+@dataclass
+class ProvisioningRun:
+    """Results and timings of a run_provisioning_dag call."""
+    results: dict
+    timings: dict
+    critical_path: list
+    elapsed: float
+
+    @property
+    def failed(self):
+        return [timing for timing in self.timings.values() if timing.status != "DONE"]
+
+def _critical_path(steps, timings):
+    """Walks back from the last step to finish through the dependency that finished last."""
+    by_name = {step.name: step for step in steps}
+    finished = [timing for timing in timings.values() if timing.status != "SKIPPED"]
+    if not finished:
+        return []
+    current = max(finished, key=lambda timing: timing.end).name
+    path = [current]
+    while by_name[current].depends_on:
+        current = max(by_name[current].depends_on, key=lambda name: timings[name].end)
+        path.append(current)
+    return path[::-1]
+
+def run_provisioning_dag(steps, max_workers=4, completed=None, on_step_done=None):
+    """
+    Runs provisioning steps on a thread pool, each one as soon as its dependencies are done.
+
+    A failed step skips the steps that depend on it; independent steps keep running.
+
+    Args:
+        steps: A list of ProvisioningStep.
+        max_workers: The maximum number of steps running at the same time.
+        completed: A dict of step name -> result for the steps done by an earlier run, they are not run again unless they are not resumable.
+        on_step_done: Called with the StepTiming and result of each step once it is done, failed or skipped.
+
+    Returns:
+        A ProvisioningRun with the result, timing and critical path of the steps.
+    """
+    names = {step.name for step in steps}
+    for step in steps:
+        missing = set(step.depends_on) - names
+        if missing:
+            raise ValueError(f"Step '{step.name}' depends on unknown steps: {sorted(missing)}")
+    # Topological check: a cycle would leave steps pending with nothing to run
+    ordered = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [step for step in remaining if ordered.issuperset(step.depends_on)]
+        if not ready:
+            raise ValueError(f"Steps with a dependency cycle: {sorted(step.name for step in remaining)}")
+        ordered.update(step.name for step in ready)
+        remaining = [step for step in remaining if step.name not in ordered]
+
+    origin = time.monotonic()
+    resumable = {step.name for step in steps if step.resumable}
+    results = {name: result for name, result in (completed or {}).items() if name in resumable}
+    timings = {name: StepTiming(name, "DONE") for name in results}
+    pending = [step for step in steps if step.name not in results]
+    running = {}
+
+    def run_step(step, inputs):
+        timing = StepTiming(step.name, "DONE", start=time.monotonic() - origin)
+        try:
+            with get_tracer().span(step.name, kind="step"):
+                return step.run(inputs), timing
+        except Exception as e:
+            timing.status = "FAILED"
+            timing.error = str(e)
+            timing.exception = e
+            return None, timing
+        finally:
+            timing.end = time.monotonic() - origin
+
+    with _st_thread_pool(max_workers) as executor:
+        while pending or running:
+            for step in list(pending):
+                dependencies = [timings.get(name) for name in step.depends_on]
+                if any(timing is not None and timing.status != "DONE" for timing in dependencies):
+                    pending.remove(step)
+                    now = time.monotonic() - origin
+                    timings[step.name] = StepTiming(step.name, "SKIPPED", start=now, end=now)
+                    if on_step_done is not None:
+                        on_step_done(timings[step.name], None)
+                elif all(timing is not None for timing in dependencies):
+                    pending.remove(step)
+                    inputs = {name: results[name] for name in step.depends_on}
+                    running[_submit(executor, run_step, step, inputs)] = step
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                results[step.name], timings[step.name] = future.result()
+                if on_step_done is not None:
+                    on_step_done(timings[step.name], results[step.name])
+
+    return ProvisioningRun(results, timings, _critical_path(steps, timings), time.monotonic() - origin)
+
+def base_environment_steps(project_id, owner, email=None, creation_id=None):
+    """
+    Describes the provisioning of a project without its VMs as a dependency graph.
+
+    The bucket is created while the Compute Engine API, VPC and service account are being prepared.
+    Once the API is enabled, a "preflight" step lists what the project already has, so that
+    the following steps only create what is missing instead of probing each resource.
+
+    Args:
+        project_id: The ID of the project to create.
+        owner: The username the project is labelled with.
+        email: The email address of the authenticated user the project is labelled with, if known.
+        creation_id: The "creation-id" label of the project, the same for every run of a job so that a resumed
+            run takes over its project; a new one if None.
+
+    Returns:
+        A list of ProvisioningStep for run_provisioning_dag, ending with the "preflight", "network" and "service_account" steps.
+    """
+    creation_id = creation_id or uuid.uuid4().hex
+
+    def enable_compute(inputs):
+        enable_compute_engine_api(project_id)
+        return wait_until_ready(lambda: compute_api_ready(project_id), "Compute Engine API")
+
+    def network(inputs):
+        create_custom_vpc_with_subnet(project_id, region, ProjectState(**inputs["preflight"]))
+        return wait_until_ready(lambda: subnet_ready(project_id, region), "Subnet")
+
+    def service_account(inputs):
+        service_account_email = f"{inputs['project']['project_number']}-compute@developer.gserviceaccount.com"
+        wait_until_ready(lambda: service_account_ready(project_id, service_account_email), "Compute Engine default service account")
+        return service_account_email
+
+    return [
+        ProvisioningStep("folder", lambda inputs: resolve_folder_id(get_client("folders"), TARGET_FOLDER_PATH)),
+        ProvisioningStep("project", lambda inputs: create_project(project_id, inputs["folder"], environment_labels(owner, email, creation_id=creation_id)), ("folder",)),
+        ProvisioningStep("billing", lambda inputs: attach_billing_account(project_id), ("project",)),
+        ProvisioningStep("compute_api", enable_compute, ("billing",)),
+        ProvisioningStep("bucket", lambda inputs: create_regional_standard_bucket(project_id, region, inputs["project"]["project_number"]).name, ("project", "billing")),
+        ProvisioningStep("preflight", lambda inputs: asdict(fetch_project_state(project_id, region)), ("compute_api",), resumable=False),
+        ProvisioningStep("network", network, ("preflight",)),
+        ProvisioningStep("service_account", service_account, ("project", "compute_api")),
+    ]
+
+def instances_step(project_id, name_project, vm_count, second_disk_size_gb, depends_on=("preflight", "network", "service_account")):
+    """
+    Describes the creation of the VMs of an environment as a provisioning step.
+
+    Args:
+        project_id: The ID of the project.
+        name_project: The username used to name the VMs.
+        vm_count: The number of VMs to create.
+        second_disk_size_gb: The size of the second disk of each VM in GB.
+        depends_on: The steps to wait for, two of them must be "preflight" and "service_account".
+
+    Returns:
+        A ProvisioningStep named "instances".
+    """
+    # Machine and disk types are resolved in the zone of each VM, the subnet covers every zone of the region
+    machine_type = "e2-medium"
+    compute_subnet_name = f"projects/{project_id}/regions/{region}/subnetworks/{subnet_name}"
+    disk_size_gb = 50
+    disk_type = "pd-balanced"
+    second_disk_type = "pd-balanced"
+
+    def instances(inputs):
+        state = ProjectState(**inputs["preflight"])
+        return create_environment_instances(project_id, name_project, vm_count, inputs["service_account"], machine_type, compute_subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type, state)
+
+    return ProvisioningStep("instances", instances, tuple(depends_on))
+
+def environment_steps(project_id, name_project, vm_count, second_disk_size_gb, email=None, creation_id=None):
+    """
+    Describes the provisioning of an environment as a dependency graph.
+
+    The VMs start as soon as the subnet and service account are usable.
+
+    Args:
+        project_id: The ID of the project to create.
+        name_project: The username used to name the VMs.
+        vm_count: The number of VMs to create.
+        second_disk_size_gb: The size of the second disk of each VM in GB.
+        email: The email address of the authenticated user, if known.
+        creation_id: Passed to base_environment_steps.
+
+    Returns:
+        A list of ProvisioningStep for run_provisioning_dag.
+    """
+    return base_environment_steps(project_id, name_project, email, creation_id) + [instances_step(project_id, name_project, vm_count, second_disk_size_gb)]
+
+def claimed_environment_steps(claim, name_project, vm_count, second_disk_size_gb):
+    """
+    Describes the provisioning of an environment in a project claimed from the warm pool, where only the VMs remain to be created.
+
+    Args:
+        claim: The dict returned by claim_pool_project.
+        The remaining arguments are the same as for environment_steps.
+
+    Returns:
+        A list of ProvisioningStep for run_provisioning_dag.
+    """
+    return [
+        ProvisioningStep("preflight", lambda inputs: asdict(fetch_project_state(claim["project_id"], region)), resumable=False),
+        ProvisioningStep("service_account", lambda inputs: claim["service_account_email"]),
+        instances_step(claim["project_id"], name_project, vm_count, second_disk_size_gb, depends_on=("preflight", "service_account")),
+    ]
+
+def _label_value(text):
+    """Turns free text (e.g. a username) into a valid label value."""
+    return "".join(c if c.isalnum() or c in "-_" else "-" for c in text.lower())[:63]
+
+def _email_label(email):
+    """
+    Returns the label value of an email address, a digest of the full address.
+
+    _label_value would map different addresses (e.g. a.b@x.com and a-b@x.com) to the same value.
+    """
+    return hashlib.sha256(email.encode()).hexdigest()[:40]
+
+def _state_db():
+    """
+    Opens a connection to the local state database, creating its tables if needed.
+
+    The connection is in autocommit mode, transactions are started explicitly.
+    """
+    connection = sqlite3.connect(STATE_DB_PATH, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS warm_pool ("
+        "project_id TEXT PRIMARY KEY, project_number TEXT, service_account_email TEXT, "
+        "state TEXT NOT NULL, owner TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "job_id TEXT PRIMARY KEY, owner TEXT NOT NULL, project_id TEXT NOT NULL, params TEXT NOT NULL, "
+        "status TEXT NOT NULL, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS job_steps ("
+        "job_id TEXT NOT NULL, step TEXT NOT NULL, status TEXT NOT NULL, result TEXT, error TEXT, "
+        "started_at REAL NOT NULL, finished_at REAL NOT NULL, PRIMARY KEY (job_id, step))"
+    )
+    return connection
+
+def _set_pool_state(project_id, state, **fields):
+    """Updates the state of a warm pool project, with optional extra columns."""
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    with closing(_state_db()) as db:
+        db.execute(
+            f"UPDATE warm_pool SET state = ?, updated_at = ?{', ' + columns if columns else ''} WHERE project_id = ?",
+            (state, time.time(), *fields.values(), project_id),
+        )
+
+def prepare_pool_project():
+    """
+    Provisions a project without VMs and adds it to the warm pool.
+
+    A project whose preparation failed is torn down, so that it does not use up the project quota.
+    The project number is saved as soon as the project is created: a row without one has no
+    project to delete (the creation failed, or the ID belongs to another project).
+
+    Returns:
+        The ID of the project, in the "ready" state if its preparation succeeded, otherwise
+        "deleted", or "failed" if its teardown failed too.
+    """
+    project_id = generate_unique_project_id("pool")
+    now = time.time()
+    with closing(_state_db()) as db:
+        db.execute(
+            "INSERT INTO warm_pool (project_id, state, created_at, updated_at) VALUES (?, 'preparing', ?, ?)",
+            (project_id, now, now),
+        )
+
+    def on_step_done(timing, result):
+        if timing.name == "project" and timing.status == "DONE":
+            _set_pool_state(project_id, "preparing", project_number=result["project_number"])
+
+    with traced(trace=f"pool-{project_id}", project=project_id):
+        run = run_provisioning_dag(base_environment_steps(project_id, "pool"), on_step_done=on_step_done)
+    if run.failed:
+        errors = "; ".join(f"{timing.name}: {timing.error or timing.status}" for timing in run.failed)
+        _set_pool_state(project_id, "failed", error=errors)
+        print(f"Warm pool project {project_id} failed: {errors}")
+        if run.timings["project"].status == "DONE":
+            teardown_environment(project_id)
+        else:
+            _set_pool_state(project_id, "deleted")
+    else:
+        _set_pool_state(
+            project_id, "ready",
+            project_number=run.results["project"]["project_number"],
+            service_account_email=run.results["service_account"],
+        )
+        print(f"Warm pool project {project_id} ready after {run.elapsed:.0f}s")
+    return project_id
+
+def claim_pool_project(owner, email=None):
+    """
+    Atomically takes a ready project out of the warm pool and relabels it for its new owner.
+
+    Args:
+        owner: The username the environment is created for.
+        email: The email address of the authenticated user, if known.
+
+    Returns:
+        A dict with the project ID, project number and service account email, or None if no project is ready.
+
+    Raises:
+        ValueError: If the project could not be relabelled, it is then put back in the pool.
+    """
+    with closing(_state_db()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute(
+            "SELECT * FROM warm_pool WHERE state = 'ready' ORDER BY created_at LIMIT 1"
+        ).fetchone()
+        if row is None:
+            db.execute("COMMIT")
+            return None
+        db.execute(
+            "UPDATE warm_pool SET state = 'claimed', owner = ?, updated_at = ? WHERE project_id = ?",
+            (owner, time.time(), row["project_id"]),
+        )
+        db.execute("COMMIT")
+
+    project = resourcemanager_v3.Project()
+    project.name = f"projects/{row['project_id']}"
+    project.display_name = f"project-{owner}"[:30]
+    project.labels = environment_labels(owner, email)
+    try:
+        operation = get_client("projects").update_project(
+            project=project, update_mask=field_mask_pb2.FieldMask(paths=["display_name", "labels"])
+        )
+        wait_for_operation(operation, "project.relabel.wait")
+    except Exception as e:
+        # Unlabelled, the project would be missing from the inventory of its owner and expire with the pool labels
+        _set_pool_state(row["project_id"], "ready", owner=None)
+        raise ValueError(f"Could not relabel warm pool project {row['project_id']} for {owner}: {e}")
+    return {
+        "project_id": row["project_id"],
+        "project_number": row["project_number"],
+        "service_account_email": row["service_account_email"],
+    }
+
+def _warm_pool_loop(size, interval, max_backoff=WARM_POOL_MAX_BACKOFF, max_failed_rounds=WARM_POOL_MAX_FAILED_ROUNDS):
+    """
+    Keeps size projects ready or being prepared in the warm pool, and tears down the failed ones.
+
+    When every preparation of a round fails, the next check waits twice as long, up to max_backoff
+    seconds, and after max_failed_rounds such rounds in a row the pool stops creating projects:
+    a persistent failure (billing quota, folder, image) would otherwise create a project per check.
+    """
+    delay = interval
+    failed_rounds = 0
+    while failed_rounds < max_failed_rounds:
+        try:
+            with closing(_state_db()) as db:
+                # Without a project number the project was never created, deleting it would fail at every round
+                db.execute("UPDATE warm_pool SET state = 'deleted', updated_at = ? WHERE state = 'failed' AND project_number IS NULL", (time.time(),))
+                failed = [row[0] for row in db.execute("SELECT project_id FROM warm_pool WHERE state = 'failed'")]
+                available = db.execute(
+                    "SELECT COUNT(*) FROM warm_pool WHERE state IN ('preparing', 'ready')"
+                ).fetchone()[0]
+            # Failed projects left by an interrupted preparation or a failed teardown
+            teardown_environments(failed)
+            missing = size - available
+            if missing > 0:
+                with ThreadPoolExecutor(max_workers=missing) as executor:
+                    prepared = list(executor.map(lambda _: prepare_pool_project(), range(missing)))
+                with closing(_state_db()) as db:
+                    ready = db.execute(
+                        f"SELECT COUNT(*) FROM warm_pool WHERE state = 'ready' AND project_id IN ({', '.join('?' * len(prepared))})",
+                        prepared,
+                    ).fetchone()[0]
+                if not ready:
+                    raise ValueError(f"none of the {missing} projects could be prepared")
+            delay = interval
+            failed_rounds = 0
+        except Exception as e:
+            delay = min(delay * 2, max_backoff)
+            failed_rounds += 1
+            print(f"Warm pool replenishment failed ({failed_rounds}/{max_failed_rounds}), next check in {delay:.0f}s: {e}")
+        time.sleep(delay)
+    print(f"Warm pool disabled after {max_failed_rounds} failed rounds in a row.")
+
+@st.cache_resource
+def start_warm_pool(size=WARM_POOL_SIZE, interval=WARM_POOL_CHECK_INTERVAL):
+    """
+    Starts the background thread that replenishes the warm pool, once per process.
+
+    Projects left in the "preparing" state by a previous process are marked as failed, to be torn down.
+    """
+    with closing(_state_db()) as db:
+        db.execute(
+            "UPDATE warm_pool SET state = 'failed', error = 'interrupted', updated_at = ? WHERE state = 'preparing'",
+            (time.time(),),
+        )
+    worker = threading.Thread(target=_warm_pool_loop, args=(size, interval), name="warm-pool", daemon=True)
+    worker.start()
+    return worker
+
+def environment_labels(owner, email=None, ttl_hours=ENVIRONMENT_TTL_HOURS, creation_id=None):
+    """
+    Returns the labels marking a project as an environment of this app, found later by find_environments.
+
+    Args:
+        owner: The username the environment is created for.
+        email: The email address of the authenticated user, if known.
+        ttl_hours: The number of hours before the environment expires.
+        creation_id: The ID of the provisioning creating the project, checked by create_project if the project exists.
+    """
+    labels = {
+        "created-by": ENVIRONMENT_LABEL,
+        "owner": _label_value(owner),
+        "expires-at": str(int(time.time() + ttl_hours * 3600)),
+    }
+    if email:
+        labels["email"] = _email_label(email)
+    if creation_id:
+        labels["creation-id"] = creation_id
+    return labels
+
+_ENVIRONMENT_ID = re.compile(r"project-.+-[0-9a-f]{4}")  # Project IDs made by generate_unique_project_id, to list unlabelled environments for review
+
+@dataclass
+class TeardownResult:
+    """Outcome of the teardown of one environment."""
+    project_id: str
+    deleted: dict  # Resource kind -> number of resources deleted
+    elapsed: float = 0.0
+    error: str = None
+
+def _list_folder_projects():
+    """Lists the projects of TARGET_FOLDER_PATH, leaving out unclaimed warm pool projects and projects with a job still running."""
+    folder_id = resolve_folder_id(get_client("folders"), TARGET_FOLDER_PATH)
+    if folder_id is None:
+        raise ValueError(f"Folder path '{TARGET_FOLDER_PATH}' not found.")
+    with closing(_state_db()) as db:
+        busy = {row[0] for row in db.execute("SELECT project_id FROM warm_pool WHERE state IN ('preparing', 'ready')")}
+        busy |= {row[0] for row in db.execute("SELECT project_id FROM jobs WHERE status IN ('queued', 'running')")}
+    return [project for project in get_client("projects").list_projects(parent=folder_id) if project.project_id not in busy]
+
+def find_environments(owner=None, expired_only=False):
+    """
+    Lists the environments in TARGET_FOLDER_PATH, i.e. the projects labelled created-by=ENVIRONMENT_LABEL.
+
+    Warm pool projects not claimed yet and projects with a job still running are left out.
+
+    Args:
+        owner: Only return the environments of this username if set.
+        expired_only: Only return the environments past their expiry time.
+
+    Returns:
+        A list of dicts with the project ID, owner and expiry time (seconds since the epoch) of each environment.
+    """
+    now = time.time()
+    environments = []
+    for project in _list_folder_projects():
+        labels = dict(project.labels)
+        if labels.get("created-by") != ENVIRONMENT_LABEL:
+            continue
+        if owner is not None and labels.get("owner") != _label_value(owner):
+            continue
+        if "expires-at" in labels:
+            expires_at = float(labels["expires-at"])
+        else:
+            expires_at = project.create_time.timestamp() + ENVIRONMENT_TTL_HOURS * 3600
+        if expired_only and expires_at > now:
+            continue
+        environments.append({"project_id": project.project_id, "owner": labels.get("owner"), "expires_at": expires_at})
+    return environments
+
+def find_unlabelled_environments():
+    """
+    Lists the projects of TARGET_FOLDER_PATH without the created-by label whose ID looks like one made by this app.
+
+    These are candidates only, e.g. environments created before the labels: the ID pattern
+    also matches projects this app did not create, so they are never deleted automatically
+    and must be reviewed before being passed to teardown_environments.
+
+    Returns:
+        A list of dicts with the project ID and creation time (seconds since the epoch) of each candidate.
+    """
+    return [
+        {"project_id": project.project_id, "created_at": project.create_time.timestamp()}
+        for project in _list_folder_projects()
+        if dict(project.labels).get("created-by") != ENVIRONMENT_LABEL and _ENVIRONMENT_ID.fullmatch(project.project_id)
+    ]
+
+def _delete_compute_resources(kind, project_id, requests):
+    """
+    Deletes Compute Engine resources in parallel, then waits for all the deletions with the operation tracker.
+
+    Args:
+        kind: The client kind (e.g. "instances").
+        project_id: The ID of the project.
+        requests: The keyword arguments of each delete call.
+
+    Returns:
+        A dict with the number of resources deleted under kind.
+    """
+    client = get_client(kind)
+
+    def delete(kwargs):
+        try:
+            return get_operation_tracker().track(client.delete(**kwargs), project_id, f"{kind}.delete.wait")
+        except exceptions.NotFound:
+            return None
+
+    with _st_thread_pool(max(1, min(TEARDOWN_MAX_WORKERS, len(requests)))) as executor:
+        futures = [_submit(executor, delete, kwargs) for kwargs in requests]
+    operations = [operation.result() for operation in (future.result() for future in futures) if operation is not None]
+    errors = [str(operation.error) for operation in operations if operation.error]
+    if errors:
+        raise ValueError(f"Could not delete {len(errors)} {kind}: {'; '.join(errors)}")
+    return {kind: len(operations)}
+
+def empty_and_delete_bucket(bucket_name):
+    """
+    Deletes a bucket after its objects, removed with batched requests of up to 100 deletions.
+
+    Args:
+        bucket_name: The name of the bucket.
+
+    Returns:
+        A dict with the number of objects and buckets deleted.
+    """
+    # A batch collects the calls of every thread using its client, so this client is not shared
+    storage_client = get_client_registry().create("storage")
     bucket = storage_client.bucket(bucket_name)
+    deleted = 0
+    try:
+        for page in storage_client.list_blobs(bucket_name, page_size=1000).pages:
+            names = [blob.name for blob in page]
+            for index in range(0, len(names), 100):
+                with storage_client.batch(raise_exception=False):
+                    for name in names[index:index + 100]:
+                        bucket.delete_blob(name)
+            deleted += len(names)
+        # Fails if a deletion in a batch failed, as the bucket is not empty
+        bucket.delete()
+    except exceptions.NotFound:
+        return {"objects": deleted, "buckets": 0}
+    return {"objects": deleted, "buckets": 1}
+
+def teardown_steps(project_id):
+    """
+    Describes the deletion of an environment as a dependency graph.
+
+    The VMs and the bucket are deleted at the same time, then the subnet once no
+    VM uses it, the network, and the project last.
 
-    for uploaded_file in uploaded_files:
+    Args:
+        project_id: The ID of the project to delete.
+
+    Returns:
+        A list of ProvisioningStep for run_provisioning_dag, each one returning the number of resources it deleted.
+    """
+    def state(inputs):
         try:
-            file_name = uploaded_file.name
-            blob = bucket.blob(file_name)
-            with st.spinner("Uploading...", show_time=True):
-                blob.upload_from_file(uploaded_file)
-            st.success(f"File '{file_name}' uploaded.", icon="✅")
+            return asdict(fetch_project_state(project_id, region))
+        except (exceptions.Forbidden, exceptions.NotFound):
+            # The Compute Engine API is not enabled or the project is already gone, so there is no VM or network
+            return asdict(ProjectState([], [], {}))
+
+    def instances(inputs):
+        found = ProjectState(**inputs["state"]).instances
+        return _delete_compute_resources("instances", project_id, [{"project": project_id, "zone": instance_zone, "instance": name} for name, instance_zone in found.items()])
+
+    def subnet(inputs):
+        found = subnet_name in inputs["state"]["subnetworks"]
+        return _delete_compute_resources("subnetworks", project_id, [{"project": project_id, "region": region, "subnetwork": subnet_name}] if found else [])
+
+    def network(inputs):
+        found = network_name in inputs["state"]["networks"]
+        return _delete_compute_resources("networks", project_id, [{"project": project_id, "network": network_name}] if found else [])
+
+    def project(inputs):
+        try:
+            operation = get_client("projects").delete_project(name=f"projects/{project_id}")
+        except exceptions.NotFound:
+            return {"projects": 0}
+        wait_for_operation(operation, "project.delete.wait")
+        return {"projects": 1}
+
+    return [
+        ProvisioningStep("state", state),
+        ProvisioningStep("instances", instances, ("state",)),
+        ProvisioningStep("bucket", lambda inputs: empty_and_delete_bucket(project_id)),
+        ProvisioningStep("subnet", subnet, ("state", "instances")),
+        ProvisioningStep("network", network, ("state", "subnet")),
+        ProvisioningStep("project", project, ("network", "bucket")),
+    ]
+
+def teardown_environment(project_id):
+    """
+    Deletes an environment: its VMs, subnet, network, bucket and project.
+
+    Args:
+        project_id: The ID of the project of the environment.
+
+    Returns:
+        A TeardownResult.
+    """
+    with traced(trace=f"teardown-{project_id}", project=project_id):
+        run = run_provisioning_dag(teardown_steps(project_id))
+    deleted = Counter()
+    for step in ("instances", "subnet", "network", "bucket", "project"):
+        deleted.update(run.results.get(step) or {})
+    error = "; ".join(f"{timing.name}: {timing.error or timing.status}" for timing in run.failed) or None
+    if run.timings["project"].status == "DONE":
+        # Also when the project was never created, e.g. a warm pool project that failed early
+        _set_pool_state(project_id, "deleted")
+    print(f"Environment {project_id} {'teardown failed' if error else 'deleted'} after {run.elapsed:.0f}s: {dict(deleted)}{f' ({error})' if error else ''}")
+    return TeardownResult(project_id, dict(deleted), run.elapsed, error)
+
+def teardown_environments(project_ids, max_workers=TEARDOWN_MAX_WORKERS):
+    """
+    Deletes several environments in parallel.
+
+    Args:
+        project_ids: The IDs of the projects of the environments.
+        max_workers: The maximum number of environments deleted at the same time.
+
+    Returns:
+        A list of TeardownResult, in the same order as project_ids.
+    """
+    if not project_ids:
+        return []
+    with _st_thread_pool(min(max_workers, len(project_ids))) as executor:
+        futures = [_submit(executor, teardown_environment, project_id) for project_id in project_ids]
+        return [future.result() for future in futures]
+
+def sweep_expired_environments(dry_run=False):
+    """
+    Deletes every labelled environment past its expiry time.
+
+    Args:
+        dry_run: Only list the expired environments instead of deleting them.
+
+    Returns:
+        A list of TeardownResult, one per expired environment, or with dry_run the list of find_environments.
+    """
+    start = time.monotonic()
+    expired = find_environments(expired_only=True)
+    if dry_run:
+        print(f"Expired environments sweep (dry run): would delete {[environment['project_id'] for environment in expired]}")
+        return expired
+    results = teardown_environments([environment["project_id"] for environment in expired])
+    reclaimed = Counter()
+    for result in results:
+        reclaimed.update(result.deleted)
+    failed = sum(1 for result in results if result.error)
+    print(f"Expired environments sweep: {len(results) - failed} deleted, {failed} failed in {time.monotonic() - start:.0f}s, reclaimed {dict(reclaimed)}")
+    return results
+
+def _teardown_sweep_loop(interval):
+    """Runs sweep_expired_environments every interval seconds."""
+    while True:
+        try:
+            sweep_expired_environments()
         except Exception as e:
-            st.error(f"Error uploading file '{file_name}': {e}")
-            return
+            print(f"Expired environments sweep failed: {e}")
+        time.sleep(interval)
+
+@st.cache_resource
+def start_teardown_sweep(interval=TEARDOWN_SWEEP_INTERVAL):
+    """Starts the background thread that deletes the expired environments, once per process."""
+    worker = threading.Thread(target=_teardown_sweep_loop, args=(interval,), name="teardown-sweep", daemon=True)
+    worker.start()
+    return worker
+
+@dataclass
+class VmInventory:
+    """A VM of an environment, as shown on the "Access your VMs" tab."""
+    name: str
+    zone: str
+    status: str
+    internal_ip: str = None
+    external_ip: str = None
+
+@dataclass
+class ProjectInventory:
+    """The bucket and VMs of an environment, and when they were listed."""
+    project_id: str
+    bucket: str
+    vms: list
+    fetched_at: float
+
+def fetch_project_inventory(project_id):
+    """
+    Lists the bucket and the VMs of an environment, in two API calls.
+
+    Args:
+        project_id: The ID of the project of the environment.
+
+    Returns:
+        A ProjectInventory.
+    """
+    fetched_at = time.monotonic()
+    vms = []
+    try:
+        request = compute_v1.AggregatedListInstancesRequest(project=project_id)
+        for scope, scoped_list in get_client("instances").aggregated_list(request=request):
+            for instance in scoped_list.instances:
+                interface = instance.network_interfaces[0] if instance.network_interfaces else None
+                access = interface.access_configs[0] if interface is not None and interface.access_configs else None
+                vms.append(VmInventory(
+                    instance.name, scope.rsplit("/", 1)[-1], instance.status,
+                    interface.network_i_p if interface is not None else None,
+                    access.nat_i_p if access is not None else None,
+                ))
+    except (exceptions.Forbidden, exceptions.NotFound):
+        # The Compute Engine API is not enabled yet
+        pass
+    try:
+        bucket = get_client("storage").get_bucket(project_id).name  # The bucket is named after the project
+    except exceptions.NotFound:
+        bucket = None
+    return ProjectInventory(project_id, bucket, sorted(vms, key=lambda vm: vm.name), fetched_at)
+
+class EnvironmentInventory:
+    """
+    Per-user cache of the environments, their bucket and VMs, shared by every session of the process.
+
+    The projects of a user are listed again every projects_ttl seconds, and the
+    bucket and VMs of each project every ttl seconds, only for the projects whose
+    entry has expired. Reruns and tab switches within these delays make no API call.
+    """
+
+    def __init__(self, ttl=None, projects_ttl=None):
+        self.ttl = INVENTORY_TTL if ttl is None else ttl
+        self.projects_ttl = INVENTORY_PROJECTS_TTL if projects_ttl is None else projects_ttl
+        self._users = {}  # Email -> {"listed_at", "project_ids", "projects": project ID -> ProjectInventory, "version"}
+        self._refreshes = {}  # Email -> Future of its running background refresh
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="inventory")
+
+    def get(self, user, wait=True):
+        """
+        Returns the environments of a user.
+
+        Args:
+            user: The email address the environments were created for.
+            wait: Whether to wait for expired entries to be listed again. If False, they
+                are refreshed in the background and the cached entries are returned.
+
+        Returns:
+            A list of ProjectInventory, the most recent project first, or None if
+            wait is False and the environments of the user were never listed.
+        """
+        with self._lock:
+            previous = refresh = self._refreshes.get(user)
+            if refresh is None or refresh.done():
+                refresh = self._refreshes[user] = self._executor.submit(self._refresh, user)
+        if wait:
+            return refresh.result()
+        with self._lock:
+            entry = self._users.get(user)
+            if entry is None:
+                if previous is not None and previous.done() and previous.exception() is not None:
+                    raise previous.exception()
+                return None
+            return [entry["projects"][project_id] for project_id in entry["project_ids"] if project_id in entry["projects"]]
 
-def create_regional_standard_bucket(project_id, region):
+    def invalidate(self, user, project_id=None):
+        """Forgets the projects of a user, or only one of them, so that the next get lists them again."""
+        with self._lock:
+            entry = self._users.get(user)
+            if entry is None:
+                return
+            if project_id is None or project_id not in entry["project_ids"]:
+                entry["listed_at"] = -math.inf
+            entry["projects"].pop(project_id, None)
+            entry["version"] += 1
+
+    def _refresh(self, user):
+        """Lists again the expired entries of a user, one refresh per user at a time, and returns its environments."""
+        with self._lock:
+            entry = self._users.get(user) or {"listed_at": -math.inf, "project_ids": [], "projects": {}, "version": 0}
+            listed_at, project_ids, projects, version = entry["listed_at"], list(entry["project_ids"]), dict(entry["projects"]), entry["version"]
+        now = time.monotonic()
+        if now - listed_at > self.projects_ttl:
+            project_ids = self._list_projects(user)
+            listed_at = now
+        stale = [project_id for project_id in project_ids if project_id not in projects or now - projects[project_id].fetched_at > self.ttl]
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(len(stale), INVENTORY_MAX_WORKERS)) as executor:
+                for project in executor.map(fetch_project_inventory, stale):
+                    projects[project.project_id] = project
+        projects = {project_id: projects[project_id] for project_id in project_ids}
+        with self._lock:
+            current = self._users.get(user)
+            if current is not None and current["version"] != version:
+                # Invalidated while listing: list again at the next get, and drop the forgotten projects not listed since
+                listed_at = -math.inf
+                version = current["version"]
+                projects = {project_id: project for project_id, project in projects.items() if project_id in current["projects"] or project.fetched_at >= now}
+            self._users[user] = {"listed_at": listed_at, "project_ids": project_ids, "projects": projects, "version": version}
+        return [projects[project_id] for project_id in project_ids]
+
+    @staticmethod
+    def _list_projects(user):
+        """
+        Returns the IDs of the projects of a user in TARGET_FOLDER_PATH, most recent first.
+
+        Ownership is read from the projects themselves, so that it survives a restart of the
+        instance and is the same on every instance: a project of the user is in the folder,
+        created by this app and labelled with the digest of the user's full email address.
+        """
+        folder_id = resolve_folder_id(get_client("folders"), TARGET_FOLDER_PATH)
+        if folder_id is None:
+            raise ValueError(f"Folder path '{TARGET_FOLDER_PATH}' not found.")
+        label = _email_label(user)
+        projects = [
+            project for project in get_client("projects").list_projects(parent=folder_id)
+            if project.labels.get("created-by") == ENVIRONMENT_LABEL and project.labels.get("email") == label
+        ]
+        return [project.project_id for project in sorted(projects, key=lambda project: project.create_time, reverse=True)]
+
+@st.cache_resource
+def get_environment_inventory():
+    """Returns the environment inventory of the process."""
+    return EnvironmentInventory()
+
+def _job_steps(params):
+    """Rebuilds the provisioning steps of a job from its parameters."""
+    if params["claim"] is not None:
+        return claimed_environment_steps(params["claim"], params["name_project"], params["vm_count"], params["second_disk_size_gb"])
+    return environment_steps(params["project_id"], params["name_project"], params["vm_count"], params["second_disk_size_gb"], params.get("email"), params.get("creation_id"))
+
+def _to_json(value):
+    """Serializes a step result, dataclasses (e.g. InstanceResult) as dicts."""
+    return json.dumps(value, default=lambda o: asdict(o) if is_dataclass(o) else str(o))
+
+def run_job(job_id):
+    """
+    Runs the provisioning steps of a job, skipping the steps done by an earlier, interrupted run.
+
+    The state of each step is saved as soon as it ends, so the job can be resumed after a restart.
+    """
+    with closing(_state_db()) as db:
+        job = db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        completed = {
+            row["step"]: json.loads(row["result"])
+            for row in db.execute("SELECT * FROM job_steps WHERE job_id = ? AND status = 'DONE'", (job_id,))
+        }
+        db.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def on_step_done(timing, result):
+        now = time.time()
+        with closing(_state_db()) as db:
+            db.execute(
+                "INSERT OR REPLACE INTO job_steps (job_id, step, status, result, error, started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, timing.name, timing.status, _to_json(result), timing.error, now - timing.elapsed, now),
+            )
+
+    params = json.loads(job["params"])
+    try:
+        for attempt in range(PROJECT_ID_ATTEMPTS):
+            with traced(trace=job_id, project=params["project_id"]):
+                run = run_provisioning_dag(_job_steps(params), completed=completed, on_step_done=on_step_done)
+            project = run.timings.get("project")
+            if attempt == PROJECT_ID_ATTEMPTS - 1 or project is None or not isinstance(project.exception, ProjectIdTakenError):
+                break
+            # Nothing was created under the generated ID, start again with a new one
+            print(f"Job {job_id}: {project.error} Retrying with a new project ID.")
+            params["project_id"] = generate_unique_project_id(params["name_project"])
+            completed = {}
+            with closing(_state_db()) as db:
+                db.execute("DELETE FROM job_steps WHERE job_id = ?", (job_id,))
+                db.execute(
+                    "UPDATE jobs SET project_id = ?, params = ?, updated_at = ? WHERE job_id = ?",
+                    (params["project_id"], json.dumps(params), time.time(), job_id),
+                )
+        status = "failed" if run.failed else "done"
+        error = "; ".join(f"{timing.name}: {timing.error or timing.status}" for timing in run.failed) or None
+    except Exception as e:
+        status, error = "failed", str(e)
+    with closing(_state_db()) as db:
+        db.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE job_id = ?", (status, error, time.time(), job_id))
+    if params.get("email"):
+        # List the new environment at the next inventory refresh
+        get_environment_inventory().invalidate(params["email"], params["project_id"])
+
+@st.cache_resource
+def get_job_executor(max_workers=JOB_MAX_WORKERS):
+    """
+    Returns the thread pool running provisioning jobs, shared by every session of the process.
+
+    Jobs left queued or running by a previous process are resumed.
+    """
+    if os.environ.get("K_SERVICE") and STATE_DB_PATH.startswith("/tmp/"):
+        # Cloud Run keeps /tmp in memory: the jobs only survive a restart of this instance, not its recycle
+        print(f"Warning: STATE_DB_PATH ({STATE_DB_PATH}) is not on a persistent volume, interrupted jobs are lost when the instance is recycled.")
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+    with closing(_state_db()) as db:
+        unfinished = [row["job_id"] for row in db.execute("SELECT job_id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at")]
+    for job_id in unfinished:
+        print(f"Resuming job {job_id}")
+        executor.submit(run_job, job_id)
+    return executor
+
+def submit_job(name_project, vm_count, second_disk_size_gb, email=None):
+    """
+    Queues the provisioning of an environment, in a warm pool project when one is ready.
+
+    Args:
+        name_project: The username the environment is created for.
+        vm_count: The number of VMs to create.
+        second_disk_size_gb: The size of the second disk of each VM in GB.
+        email: The email address of the authenticated user, if known.
+
+    Returns:
+        The ID of the job.
+    """
+    claim = None
+    if WARM_POOL_SIZE:
+        try:
+            claim = claim_pool_project(name_project, email)
+        except ValueError as e:
+            print(f"{e}, creating a new project instead.")
+    project_id = claim["project_id"] if claim is not None else generate_unique_project_id(name_project)
+    params = {
+        "project_id": project_id,
+        "name_project": name_project,
+        "vm_count": vm_count,
+        "second_disk_size_gb": second_disk_size_gb,
+        "claim": claim,
+        "email": email,
+    }
+    # Get the executor first, so that it does not resume the new job on top of this submit
+    executor = get_job_executor()
+    job_id = uuid.uuid4().hex
+    # Labels the project with the job, so that a resumed run can tell its project from another one with the same ID
+    params["creation_id"] = job_id
+    now = time.time()
+    with closing(_state_db()) as db:
+        db.execute(
+            "INSERT INTO jobs (job_id, owner, project_id, params, status, created_at, updated_at) VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, name_project, project_id, json.dumps(params), now, now),
+        )
+    executor.submit(run_job, job_id)
+    return job_id
+
+def get_job(job_id):
+    """
+    Reads the state of a job.
+
+    Returns:
+        The job row and the list of its step rows, or (None, []) if the job does not exist.
+    """
+    with closing(_state_db()) as db:
+        job = db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        steps = db.execute("SELECT * FROM job_steps WHERE job_id = ? ORDER BY started_at", (job_id,)).fetchall()
+    return job, steps
+
+def job_belongs_to(job, email):
+    """Whether a job row was submitted by the authenticated user with this email address (None when there is no authentication)."""
+    return json.loads(job["params"]).get("email") == email
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def job_status_panel(job_id):
+    """Shows the progress of a job, refreshed every JOB_POLL_INTERVAL seconds."""
+    job, steps = get_job(job_id)
+    if job is None:
+        st.warning(f"Job {job_id} not found.")
+        return
+    st.markdown(f"**Environment {job['project_id']}: {job['status']}**")
+    for step in steps:
+        if step["status"] == "FAILED":
+            st.error(f"An error occurred during the step '{step['step']}': {step['error']}")
+        if step["step"] == "instances" and step["status"] == "DONE":
+            for result in json.loads(step["result"]):
+                if result["status"] == "FAILED":
+                    st.error(f"Error creating instance {result['name']} after {result['elapsed']:.0f}s: {result['error']}")
+    if job["status"] == "done":
+        st.markdown("**Done !**")
+        st.markdown(f"Sign-in using your @XXX.com account and use project ID: {job['project_id']}")
+    if steps:
+        with st.expander(f"Provisioning steps ({job['updated_at'] - job['created_at']:.0f}s so far)" if job["status"] in ("queued", "running") else f"Provisioning took {job['updated_at'] - job['created_at']:.0f}s"):
+            if job["status"] == "done":
+                timings = {step["step"]: StepTiming(step["step"], step["status"], step["started_at"], step["finished_at"]) for step in steps}
+                st.markdown(f"Critical path: {' → '.join(_critical_path(_job_steps(json.loads(job['params'])), timings))}")
+            st.table([
+                {"step": step["step"], "status": step["status"], "start (s)": round(step["started_at"] - job["created_at"], 1), "duration (s)": round(step["finished_at"] - step["started_at"], 1)}
+                for step in steps
+            ])
+    trace_panel(job_id)
+
+def trace_panel(trace_id):
+    """Shows the latency breakdown of the spans of a trace, with the metrics exports."""
+    tracer = get_tracer()
+    spans = tracer.spans(trace=trace_id)
+    if not spans:
+        return
+    with st.expander("Debug: latency breakdown"):
+        totals = Counter()
+        for span in spans:
+            totals[(span.kind, span.name)] += span.duration
+        st.table([
+            {"kind": kind, "name": name, "total (s)": round(total, 2)}
+            for (kind, name), total in totals.most_common()
+        ])
+        st.dataframe([
+            {
+                "start": time.strftime("%H:%M:%S", time.localtime(span.start)),
+                "kind": span.kind,
+                "name": span.name,
+                "duration (s)": round(span.duration, 2),
+                "outcome": span.outcome,
+                "tags": ", ".join(f"{key}={value}" for key, value in span.tags.items() if key != "trace"),
+                "error": span.error,
+            }
+            for span in sorted(spans, key=lambda span: span.start)
+        ])
+        st.download_button("Spans (JSON lines)", tracer.export_jsonl(trace=trace_id), file_name=f"spans-{trace_id}.jsonl", key=f"spans-{trace_id}")
+        st.download_button("Metrics (Prometheus)", tracer.export_prometheus(), file_name="metrics.prom", key=f"metrics-{trace_id}")
+
+@st.cache_resource
+def start_background_services(delay=BACKGROUND_START_DELAY):
+    """
+    Starts, once per process, the background work that needs the Google Cloud client libraries.
+
+    It begins delay seconds after the first page load, so that a cold start is
+    not slowed down by the folder cache, the warm pool, the expired environments
+    sweep or the resumption of interrupted jobs.
+    """
+    def start():
+        time.sleep(delay)
+        get_job_executor()
+        warm_folder_cache()
+        if WARM_POOL_SIZE:
+            start_warm_pool()
+        if TEARDOWN_SWEEP_INTERVAL:
+            start_teardown_sweep()
+
+    worker = threading.Thread(target=start, name="background-services", daemon=True)
+    worker.start()
+    return worker
+
+@st.fragment(run_every=INVENTORY_POLL_INTERVAL)
+def vm_inventory_panel(user_email):
+    """Shows the VMs of the environments of a user, from the shared inventory."""
+    try:
+        environments = get_environment_inventory().get(user_email, wait=False)
+    except Exception as e:
+        st.error(f"Could not list your environments: {e}")
+        return
+    if environments is None:
+        st.info("Listing your environments...")
+        return
+    if not environments:
+        st.info("You have no environment yet.")
+        return
+    for environment in environments:
+        st.markdown(f"**{environment.project_id}**")
+        if environment.vms:
+            st.dataframe([asdict(vm) for vm in environment.vms], hide_index=True)
+        else:
+            st.write("No VM")
+
+def disable():
+    st.session_state.disabled = True
+
+class _BufferSlice(io.RawIOBase):
+    """Read-only file object over a part of a memoryview, read chunk by chunk without copying the whole part."""
+
+    def __init__(self, view, start, end):
+        self._view = view[start:end]
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, min(offset, len(self._view)))
+        return self._position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self._view) - self._position)
+        buffer[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+@dataclass
+class UploadResult:
+    """Outcome of one file upload in a batch."""
+    name: str
+    size: int
+    status: str
+    elapsed: float = 0.0
+    error: str = None
+    reused_bytes: int = 0  # Bytes of parts kept from an earlier upload instead of being sent again
+
+    @property
+    def throughput(self):
+        """Upload throughput in MB/s, of the bytes actually sent."""
+        return (self.size - self.reused_bytes) / self.elapsed / 1e6 if self.elapsed else 0.0
+
+def _crc32c(view):
+    """Returns the base64 CRC32C of a buffer, in the format used by blob.crc32c."""
+    checksum = google_crc32c.Checksum()
+    for offset in range(0, len(view), UPLOAD_CHUNK_SIZE):
+        checksum.update(bytes(view[offset:offset + UPLOAD_CHUNK_SIZE]))
+    return base64.b64encode(checksum.digest()).decode("ascii")
+
+def _upload_range(bucket, blob_name, view, start, end, content_type=None):
+    """
+    Uploads view[start:end] to a blob, in UPLOAD_CHUNK_SIZE resumable chunks for large ranges.
+
+    A blob that already holds the same bytes (e.g. a part uploaded before an
+    interruption) is kept as is instead of being uploaded again.
+
+    Returns:
+        The blob, the times its upload started and ended, and whether an existing blob was reused.
+    """
+    started = time.monotonic()
+    checksum = _crc32c(view[start:end])
+    blob = bucket.get_blob(blob_name)
+    if blob is not None and blob.size == end - start and blob.crc32c == checksum:
+        return blob, started, time.monotonic(), True
+    blob = bucket.blob(blob_name)
+    if end - start > UPLOAD_CHUNK_SIZE:
+        blob.chunk_size = UPLOAD_CHUNK_SIZE
+    with get_tracer().span("storage.upload", kind="rpc", bytes=end - start):
+        blob.upload_from_file(_BufferSlice(view, start, end), size=end - start, content_type=content_type, crc32c_checksum_value=checksum)
+    return blob, started, time.monotonic(), False
+
+def _part_ranges(size):
+    """Splits a file size into at most 32 part ranges, the maximum number of sources of a compose."""
+    part_size = max(COMPOSITE_PART_SIZE, -(-size // 32))
+    part_size = -(-part_size // UPLOAD_CHUNK_SIZE) * UPLOAD_CHUNK_SIZE
+    return [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+
+def upload_files_to_bucket(project_id, uploaded_files, max_workers=UPLOAD_MAX_WORKERS):
+    """
+    Uploads Streamlit uploaded files to the bucket of the project, in parallel.
+
+    Files larger than COMPOSITE_UPLOAD_THRESHOLD are uploaded as parallel parts
+    then composed into the final object, under UPLOAD_PARTS_PREFIX. Parts
+    already present from an interrupted upload are reused and reported apart
+    from the bytes sent; the parts of an abandoned upload expire with the
+    bucket lifecycle rule. A failed file does not stop the others.
+
+    Args:
+        project_id: The ID of the project, also the name of its bucket.
+        uploaded_files: A list of streamlit UploadedFile.
+        max_workers: The maximum number of files or parts uploaded at the same time.
+
+    Returns:
+        A list of UploadResult, in the same order as uploaded_files.
+    """
+    storage_client = get_client("storage")
+    bucket_name = project_id
+    bucket = storage_client.bucket(bucket_name)
+
+    results = []
+    with traced(project=project_id), _st_thread_pool(max_workers) as executor:
+        uploads = []
+        for uploaded_file in uploaded_files:
+            # UploadedFile is an in-memory buffer, the parts are read from it without copying it
+            view = uploaded_file.getbuffer()
+            size = len(view)
+            if size > COMPOSITE_UPLOAD_THRESHOLD:
+                ranges = _part_ranges(size)
+                part_names = [f"{UPLOAD_PARTS_PREFIX}{uploaded_file.name}/{size}-{index}" for index in range(len(ranges))]
+            else:
+                ranges = [(0, size)]
+                part_names = [uploaded_file.name]
+            futures = [
+                _submit(executor, _upload_range, bucket, part_name, view, start, end, uploaded_file.type)
+                for part_name, (start, end) in zip(part_names, ranges)
+            ]
+            uploads.append((uploaded_file, size, futures))
+
+        with st.spinner("Uploading...", show_time=True):
+            for uploaded_file, size, futures in uploads:
+                file_name = uploaded_file.name
+                start = time.monotonic()
+                try:
+                    parts = [future.result() for future in futures]
+                    # The parts may have ended long before this loop reached the file, time them where they ran
+                    elapsed = max(ended for _, _, ended, _ in parts) - min(started for _, started, _, _ in parts)
+                    reused_bytes = sum(part.size for part, _, _, reused in parts if reused)
+                    if len(parts) > 1:
+                        composing = time.monotonic()
+                        blob = bucket.blob(file_name)
+                        blob.content_type = uploaded_file.type
+                        blob.compose([part for part, _, _, _ in parts])
+                        bucket.delete_blobs([part for part, _, _, _ in parts], on_error=lambda part: None)
+                        elapsed += time.monotonic() - composing
+                    result = UploadResult(file_name, size, "UPLOADED", elapsed=elapsed, reused_bytes=reused_bytes)
+                    reused = f", {reused_bytes / 1e6:.1f} MB reused from an earlier upload" if reused_bytes else ""
+                    st.success(f"File '{file_name}' uploaded ({result.throughput:.1f} MB/s{reused}).", icon="✅")
+                except Exception as e:
+                    for future in futures:
+                        future.cancel()
+                    result = UploadResult(file_name, size, "FAILED", elapsed=time.monotonic() - start, error=str(e))
+                    st.error(f"Error uploading file '{file_name}': {e}")
+                results.append(result)
+    return results
+
+def create_regional_standard_bucket(project_id, region, project_number=None):
     """
     Creates a regional standard bucket with uniform access control.
 
+    The bucket deletes the parts of composite uploads older than
+    UPLOAD_PARTS_MAX_AGE_DAYS, left behind when an upload is abandoned.
+
     Args:
         project_id: The ID of the project.
         region: The region in which to create the bucket.
+        project_number: The number of the project; if set, an existing bucket is only reused if it belongs to this project.
     """
-    storage_client = storage.Client(project=project_id)
+    storage_client = get_client("storage")
     bucket_name = project_id  # Use the project ID as the bucket name
     bucket = storage_client.bucket(bucket_name)
     bucket.location = region
     bucket.storage_class = "STANDARD"
     bucket.iam_configuration.uniform_bucket_level_access_enabled = True
+    bucket.add_lifecycle_delete_rule(age=UPLOAD_PARTS_MAX_AGE_DAYS, matches_prefix=[UPLOAD_PARTS_PREFIX])
 
     try:
-        bucket = storage_client.create_bucket(bucket)
+        bucket = storage_client.create_bucket(bucket, project=project_id)
         print(f"Bucket {bucket.name} created in {bucket.location} with storage class {bucket.storage_class} and uniform access control.")
         return bucket
+    except exceptions.Conflict:
+        # Created by an earlier, interrupted run; get_bucket fails if the name belongs to someone else
+        try:
+            existing = storage_client.get_bucket(bucket_name)
+        except Exception as e:
+            raise ValueError(f"Error creating bucket: {e}")
+        if project_number is not None and str(existing.project_number) != str(project_number):
+            raise ValueError(f"Error creating bucket: the name {bucket_name} is used by a bucket of another project.")
+        return existing
     except Exception as e:
         raise ValueError(f"Error creating bucket: {e}")
     
@@ -396,6 +2783,7 @@ if __name__ == "__main__":
     logo = "logo.png"
     st.image(logo)
     st.title('\n''XXXX Flood App''\n')
+    start_background_services()
     tab1, tab2, tab3, tab4 = st.tabs(["0-README", "1-Create your environment", "2-Upload your Data", "3-Access your VMs"])
     with tab1:
         st.write("Hello")
@@ -425,46 +2813,62 @@ if __name__ == "__main__":
         with st.form('my_form',enter_to_submit=False):
             # Every form must have a submit button
             submitted = st.form_submit_button('Start', on_click=disable, disabled=st.session_state.disabled)
+        # Environments are labelled with the authenticated email address, which the inventory lists them by
+        user_email = user_email_to_display if "@" in user_email_to_display else None
         if submitted:
-            new_project_id = generate_unique_project_id(name_project)
-            instance_name = f"instance-{uuid.uuid4().hex[:4]}"
-            machine_type = f"projects/{new_project_id}/zones/{zone}/machineTypes/e2-medium"
-            compute_subnet_name = f"projects/{new_project_id}/regions/us-central1/subnetworks/{subnet_name}"  
-            disk_size_gb = 50 # This line was already correctly indented.
-            disk_type = f"projects/{new_project_id}/zones/{zone}/diskTypes/pd-balanced"
-            second_disk_type = f"projects/{new_project_id}/zones/{zone}/diskTypes/pd-balanced"
-            try:
-                response = create_project_in_folder(new_project_id)
-            except Exception as e:
-                st.error(f"An unexpected error occurred when creating project: {e}")
-            try:
-                enable_compute_engine_api(new_project_id)
-                time.sleep(10)
-                create_regional_standard_bucket(new_project_id, region);
-                create_custom_vpc_with_subnet(new_project_id, region);
-                p_number = response["project_number"];
-                service_account_email = f"{p_number}-compute@developer.gserviceaccount.com"
-            except Exception as e:
-                print(f"An unexpected error occurred: {e}")            
-            try:
-                time.sleep(10) # This line was already correctly indented.
-                # Loop to create multiple instances
-                for i in range(int(vm_numbers)):
-                    instance_name = f"instance-{name_project}-{i}-{uuid.uuid4().hex[:4]}"  # Unique instance name
-                    create_instance(new_project_id, zone, service_account_email, instance_name, machine_type, compute_subnet_name, source_image, disk_size_gb, disk_type, second_disk_size_gb, second_disk_type)
-                st.markdown("**Done !**")
-                st.markdown(f"Sign-in using your @XXX.com account and use project ID: {new_project_id}")
-            except Exception as e:
-                st.error(f"An error occurred instance creation: {e}")    
+            st.session_state.job_id = submit_job(name_project, int(vm_numbers), second_disk_size_gb, user_email)
+            # Keep the job in the URL so a browser refresh finds it again
+            st.query_params["job"] = st.session_state.job_id
+        job_id = st.session_state.get("job_id") or st.query_params.get("job")
+        new_project_id = None
+        job_bucket = None
+        if job_id:
+            job, job_steps = get_job(job_id)
+            # The job ID may come from a shared URL, only its owner sees and deletes the environment
+            if job is not None and not job_belongs_to(job, user_email):
+                st.error("This environment belongs to another user.")
+            elif job is not None:
+                new_project_id = job["project_id"]
+                claim = json.loads(job["params"])["claim"]
+                # The bucket of a warm pool project was created with the project, otherwise by the bucket step of this job
+                job_bucket = claim["project_id"] if claim else next((json.loads(step["result"]) for step in job_steps if step["step"] == "bucket" and step["status"] == "DONE"), None)
+                job_status_panel(job_id)
+                # A project step that failed may have found a project of someone else under the same ID
+                deletable = job["status"] not in ("queued", "running") and any(step["step"] == "project" and step["status"] == "DONE" for step in job_steps)
+                confirmed = deletable and st.checkbox(f"Delete the project {new_project_id}, its VMs and its bucket")
+                if deletable and st.button("Delete this environment", disabled=not confirmed):
+                    result = teardown_environment(new_project_id)
+                    if user_email:
+                        get_environment_inventory().invalidate(user_email, new_project_id)
+                    if result.error:
+                        st.error(f"Could not delete the environment {new_project_id}: {result.error}")
+                    else:
+                        st.success(f"Environment {new_project_id} deleted in {result.elapsed:.0f}s ({result.deleted.get('instances', 0)} VMs).", icon="✅")
     with tab3:
         st.header('Upload your data')
-        uploaded_files = st.file_uploader("Choose files", accept_multiple_files=True)
-        if st.button("Upload", type="primary"):
-            if uploaded_files is not None:
-                upload_files_to_bucket(new_project_id, uploaded_files)
+        # Each environment has a bucket named after its project, the one of the current job only if the user owns the job
+        buckets = [job_bucket] if job_bucket else []
+        if user_email:
+            try:
+                environments = get_environment_inventory().get(user_email, wait=False) or []
+            except Exception as e:
+                environments = []
+                st.error(f"Could not list your environments: {e}")
+            buckets += [environment.bucket for environment in environments if environment.bucket and environment.bucket not in buckets]
+        if not buckets:
+            st.info("Create an environment first, its bucket will be listed here.")
+            st.button("Refresh")
+        else:
+            bucket_project_id = st.selectbox("Bucket", buckets)
+            uploaded_files = st.file_uploader("Choose files", accept_multiple_files=True)
+            if st.button("Upload", type="primary"):
+                if uploaded_files is not None:
+                    upload_files_to_bucket(bucket_project_id, uploaded_files)
     with tab4:
         st.markdown("- Download and install the [IAP RDP Client](https://googlecloudplatform.github.io/iap-desktop/) to access your VM")
         st.markdown("- Follow the guide here to connect to your VMs")
+        if user_email:
+            vm_inventory_panel(user_email)
 
 
         # st.write(st.context.headers) # You can keep this if you still want to see all headers for debugging
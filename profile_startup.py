@@ -0,0 +1,98 @@
+"""
+Startup profile of the app, with a time budget check.
+
+Measures, each in a new Python process as after a Cloud Run cold start:
+- the import of gcp.py, with the slowest modules reported by python -X importtime;
+- the first page load, with Streamlit's AppTest.
+Neither may load a Google Cloud client library, those are only imported by the
+first provisioning step that needs them. Exits with status 1 if a budget is
+exceeded or a client library is loaded, so it can run before each deployment.
+
+Usage:
+    python profile_startup.py --import-budget 2 --render-budget 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+CLIENT_LIBRARIES = (
+    "google.cloud.billing_v1",
+    "google.cloud.compute_v1",
+    "google.cloud.resourcemanager_v3",
+    "google.cloud.service_usage_v1",
+    "google.cloud.storage",
+    "google.api_core.exceptions",
+    "google_crc32c",
+)
+
+IMPORT_CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import gcp
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": sorted(sys.modules)}))
+"""
+
+RENDER_CHILD = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+app = AppTest.from_file("gcp.py", default_timeout=60).run()
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": sorted(sys.modules), "errors": [str(error.message) for error in app.exception]}))
+"""
+
+
+def run_child(code, importtime=False):
+    """Runs code in a new interpreter next to gcp.py and returns its JSON output and stderr."""
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    process = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+    return json.loads(process.stdout.strip().splitlines()[-1]), process.stderr
+
+
+def slowest_imports(importtime_output, count):
+    """Returns the (cumulative seconds, module) of the slowest imports made by gcp.py in python -X importtime output."""
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Direct imports of gcp.py only (indented once), nested ones are included in their cumulative time
+        if name.startswith("   ") and not name.startswith("    "):
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--import-budget", type=float, default=2.0, help="Maximum number of seconds to import gcp.py.")
+    parser.add_argument("--render-budget", type=float, default=4.0, help="Maximum number of seconds to render the first page.")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to report.")
+    args = parser.parse_args()
+
+    imported, importtime_output = run_child(IMPORT_CHILD, importtime=True)
+    rendered, _ = run_child(RENDER_CHILD)
+
+    print(f"Import of gcp.py: {imported['seconds']:.2f}s (budget {args.import_budget}s)")
+    for seconds, name in slowest_imports(importtime_output, args.top):
+        print(f"  {seconds:6.2f}s  {name}")
+    print(f"First page load: {rendered['seconds']:.2f}s (budget {args.render_budget}s)")
+
+    failures = []
+    if imported["seconds"] > args.import_budget:
+        failures.append(f"the import of gcp.py took {imported['seconds']:.2f}s, over its {args.import_budget}s budget")
+    if rendered["seconds"] > args.render_budget:
+        failures.append(f"the first page load took {rendered['seconds']:.2f}s, over its {args.render_budget}s budget")
+    for step, result in (("the import of gcp.py", imported), ("the first page load", rendered)):
+        loaded = [library for library in CLIENT_LIBRARIES if library in result["modules"]]
+        if loaded:
+            failures.append(f"{step} loaded {', '.join(loaded)}")
+    for error in rendered.get("errors", []):
+        failures.append(f"the first page load raised: {error}")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()